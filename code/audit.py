@@ -0,0 +1,233 @@
+import argparse
+from base64 import b64decode
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+import json
+import logging
+import os
+import sys
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import block_headers
+import kb_ots
+import keybase_api
+from merkle_root import load_verifier, TEMPLATE_MERKLE_URL, verify_merkle_root
+from task import decode_stamped_roots, StampedMerkleRoot, StampStatus
+
+
+# check every proof in an export of the bot's channel, e.g.
+#
+#   keybase chat api -m '{"method": "read", "params": {"options": {"channel": {"name": "kbhonest", "public": true}}}}' \
+#       | jq -c '.result.messages[]' > export.jsonl
+#   python3 code/audit.py export.jsonl --roots roots.jsonl
+#
+# for every root in every message, in a pool of worker processes:
+#   * keybase's signed root for that seqno (from --roots, the --cache-dir,
+#     or keybase.io) has to pass the same PGP checks the bot does, and hash
+#     to the b64stamped and root hash we published
+#   * the ots proof has to be for that data and, once it claims to be
+#     final, end in a bitcoin attestation (checked against the block header
+#     store if there is one)
+# failures stream out as they're found, then a summary with any gaps
+# between published roots.
+WORKERS = os.cpu_count() or 4
+CHUNK_SIZE = 64  # roots handed to a worker at a time
+MAX_GAP = 2 * 20 * 60  # seconds. the bot stamps roots minutes after keybase makes them
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(__file__), '..', 'tmp', 'roots')
+logger = logging.getLogger('audit')
+
+VERIFIED = 'verified'
+PENDING = 'pending'
+FAILED = 'failed'
+
+
+@dataclass
+class AuditResult:
+    msg_id: int
+    seqno: int
+    ctime: float
+    outcome: str
+    reason: str = ""
+    block_heights: List[int] = field(default_factory=list)
+
+
+################################
+
+# reading the export
+
+def read_export(path: str) -> Iterator[Tuple[int, List[StampedMerkleRoot]]]:
+    # one message per line, either bare or wrapped in {"msg": ...} like the
+    # chat api returns them. an edit replaces the message it edited, so only
+    # the newest copy of each message counts.
+    newest: Dict[int, Tuple[int, dict]] = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            m = json.loads(line)
+            m = m.get('msg', m)
+            content = m.get('content') or {}
+            if content.get('type') == 'text':
+                msg_id, body = m['id'], content['text']['body']
+            elif content.get('type') == 'edit':
+                edit = content['edit']
+                msg_id, body = edit.get('messageID', edit.get('message_id')), edit['body']
+            else:
+                continue
+            if msg_id not in newest or m['id'] > newest[msg_id][0]:
+                newest[msg_id] = (m['id'], body)
+
+    for msg_id, (_, body) in sorted(newest.items()):
+        try:
+            yield msg_id, decode_stamped_roots(json.loads(body))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.debug(f"message {msg_id} isn't a stamped root ({e}) - skip")
+
+
+def read_roots(path: Optional[str]) -> Dict[int, dict]:
+    # merkle root api responses, one per line
+    if not path:
+        return {}
+    with open(path) as f:
+        roots = [json.loads(line) for line in f if line.strip()]
+    return {root['seqno']: root for root in roots}
+
+
+################################
+
+# in the worker processes
+
+_cache_dir: Optional[str] = None
+_offline = False
+
+
+def init_worker(cache_dir: Optional[str], offline: bool, headers_path: Optional[str], armored_key: Optional[str]) -> None:
+    global _cache_dir, _offline
+    _cache_dir, _offline = cache_dir, offline
+    # parse the key and open the headers once per process, not once per root
+    load_verifier(armored_key)
+    if headers_path:
+        kb_ots.use_block_headers(block_headers.BlockHeaderStore(headers_path))
+    else:
+        kb_ots.use_block_headers(block_headers.open_default())
+
+
+def audit_chunk(chunk: List[Tuple[int, StampedMerkleRoot, Optional[dict]]]) -> List[AuditResult]:
+    return [audit_root(msg_id, stamped_root, full_root) for msg_id, stamped_root, full_root in chunk]
+
+
+def audit_root(msg_id, stamped_root: StampedMerkleRoot, full_root: Optional[dict]) -> AuditResult:
+    root = stamped_root.root
+    result = AuditResult(msg_id=msg_id, seqno=root.seqno, ctime=root.ctime, outcome=FAILED)
+    try:
+        # re-derive what we published from what keybase signed
+        signed = verify_merkle_root(full_root or _load_root(root.seqno))
+        if signed.b64stamped != root.b64stamped:
+            result.reason = "b64stamped isn't the hash of keybase's signature"
+            return result
+        if signed.root_hash != root.root_hash:
+            result.reason = "root hash doesn't match the one keybase signed"
+            return result
+        verified = kb_ots.check(msg_id, root.data_to_stamp, b64decode(stamped_root.ots))
+    except kb_ots.MissingHeaderError as e:
+        # on chain, but the header store hasn't caught up to its block yet
+        result.outcome = PENDING
+        result.reason = str(e)
+        return result
+    except Exception as e:
+        # anything wrong with one root (a mangled signature makes pgpy raise
+        # ValueError, say) fails that root, not the whole audit
+        result.reason = f"{type(e).__name__}: {e}"
+        return result
+
+    if verified is None:
+        if stamped_root.status == StampStatus.VERIFIABLE:
+            result.reason = "marked VERIFIABLE but the proof isn't on chain"
+            return result
+        result.outcome = PENDING
+        return result
+    result.outcome = VERIFIED
+    result.block_heights = verified.block_heights
+    return result
+
+
+def _load_root(seqno: int) -> dict:
+    path = os.path.join(_cache_dir, f"{seqno}.json") if _cache_dir else None
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    if _offline:
+        raise KeyError(f"no root for {seqno} in --roots or the cache")
+    full_root = keybase_api.fetch_json(TEMPLATE_MERKLE_URL.format(seqno=seqno)).body
+    if path:
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(full_root, f)
+        os.replace(tmp_path, path)
+    return full_root
+
+
+################################
+
+# putting it together
+
+def audit(export_path: str, roots_path: str = None, cache_dir: str = DEFAULT_CACHE_DIR, offline: bool = False,
+          headers_path: str = None, workers: int = WORKERS, max_gap: float = MAX_GAP, armored_key: str = None,
+          out=sys.stdout) -> bool:
+    # returns whether everything checked out
+    fixtures = read_roots(roots_path)
+    items = [
+        (msg_id, stamped_root, fixtures.get(stamped_root.root.seqno))
+        for msg_id, stamped_roots in read_export(export_path)
+        for stamped_root in stamped_roots
+    ]
+    chunks = [items[i:i + CHUNK_SIZE] for i in range(0, len(items), CHUNK_SIZE)]
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    print(f"auditing {len(items)} roots with {workers} workers", file=out)
+
+    results: List[AuditResult] = []
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(cache_dir, offline, headers_path, armored_key)) as pool:
+        for chunk_results in pool.map(audit_chunk, chunks):
+            for result in chunk_results:
+                if result.outcome == FAILED:
+                    print(f"FAIL seqno {result.seqno} in message {result.msg_id}: {result.reason}", file=out, flush=True)
+            results.extend(chunk_results)
+
+    counts = {outcome: sum(1 for r in results if r.outcome == outcome) for outcome in (VERIFIED, PENDING, FAILED)}
+    print(f"{counts[VERIFIED]} verified, {counts[PENDING]} pending, {counts[FAILED]} failed", file=out)
+    for earlier, later in find_gaps(results, max_gap):
+        print(f"GAP {int(later.ctime - earlier.ctime)}s between seqno {earlier.seqno} and {later.seqno}", file=out)
+    seen: Dict[int, int] = {}
+    for result in results:
+        if result.seqno in seen and seen[result.seqno] != result.msg_id:
+            print(f"DUPLICATE seqno {result.seqno} in messages {seen[result.seqno]} and {result.msg_id}", file=out)
+        seen.setdefault(result.seqno, result.msg_id)
+    return counts[FAILED] == 0
+
+
+def find_gaps(results: List[AuditResult], max_gap: float) -> List[Tuple[AuditResult, AuditResult]]:
+    # consecutive published roots further apart in time than max_gap
+    ordered = sorted((r for r in results if r.outcome != FAILED), key=lambda r: r.ctime)
+    return [(a, b) for a, b in zip(ordered, ordered[1:]) if b.ctime - a.ctime > max_gap]
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description="verify every proof in an export of the bot's channel")
+    parser.add_argument('export', help="jsonl file of chat messages")
+    parser.add_argument('--roots', help="jsonl file of keybase merkle root api responses to check against")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="where roots fetched from keybase are kept")
+    parser.add_argument('--offline', action='store_true', help="never fetch from keybase")
+    parser.add_argument('--headers', help="bitcoin block header store (default: tmp/block_headers.dat if it exists)")
+    parser.add_argument('--workers', type=int, default=WORKERS, help="worker processes")
+    parser.add_argument('--max-gap', type=float, default=MAX_GAP, help="seconds between roots before it's a gap")
+    parser.add_argument('--key', help="armored pgp key the roots are signed with (default: keybase's merkle key)")
+    args = parser.parse_args()
+    armored_key = open(args.key).read() if args.key else None
+    ok = audit(args.export, args.roots, args.cache_dir, args.offline, args.headers, args.workers, args.max_gap, armored_key)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
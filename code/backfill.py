@@ -0,0 +1,110 @@
+import argparse
+import asyncio
+import logging
+import os
+from typing import List, Optional
+
+import kb_ots
+import keybase_api
+from interactivity import new_bot
+import journal
+from merkle_root import fetch_historical_merkle_root, load_verifier, MerkleRoot, VerificationError
+from proof_index import ProofIndex
+import task
+from task import publish_stamped_roots, rebuild_index, resume
+
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s | %(levelname)s | %(name)s -- %(message)s',
+)
+FETCH_CONCURRENCY = 16
+BATCH_SIZE = 256
+# its own, so a backfill can run next to the bot without the two sharing a file
+JOURNAL_PATH = os.environ.get(
+    'BACKFILL_JOURNAL_PATH',
+    os.path.join(os.path.dirname(journal.DEFAULT_PATH), 'backfill_journal.jsonl'),
+)
+
+# stamp and publish every root in a range of seqnos, e.g. for a new channel
+# or after the bot has been down for a while:
+#
+#   python3 code/backfill.py 1000 5000
+#
+# progress lives in the proof index: anything already published is skipped,
+# so after a crash just run the same command again. an empty index (e.g. in
+# a fresh container) is rebuilt from the channel first. stamps are journaled
+# like the bot's, so a batch that was stamped but not published is published
+# on the next run instead of being stamped again. the running bot picks the
+# new messages up from the channel and upgrades them.
+
+
+async def fetch_roots(logger, seqnos: List[int], concurrency: int) -> List[MerkleRoot]:
+    slots = asyncio.Semaphore(concurrency)
+
+    async def fetch_one(seqno) -> Optional[MerkleRoot]:
+        async with slots:
+            try:
+                return await fetch_historical_merkle_root(seqno)
+            except (keybase_api.FetchError, VerificationError) as e:
+                logger.error(f"couldn't fetch and verify {seqno}: {e}")
+                return None
+
+    roots = await asyncio.gather(*[fetch_one(seqno) for seqno in seqnos])
+    return [root for root in roots if root is not None]
+
+
+async def backfill(start: int, end: int, concurrency: int = FETCH_CONCURRENCY, batch_size: int = BATCH_SIZE,
+                   journal_path: str = JOURNAL_PATH):
+    logger = logging.getLogger('backfill')
+    load_verifier()
+    bot = new_bot()
+    index = ProofIndex()
+    index.restore()
+    task.use_journal(journal.Journal(journal_path))
+    if index.needs_rebuild:
+        # e.g. a fresh container. read back what's in the channel first, or
+        # everything in it would be stamped and published again.
+        await rebuild_index(logger, bot, index)
+    # publish whatever the last run stamped before it stopped
+    await resume(logger, bot, index)
+
+    done = index.published_seqnos(start, end)
+    todo = [seqno for seqno in range(start, end + 1) if seqno not in done]
+    logger.info(f"{len(done)} of {end - start + 1} seqnos already published. {len(todo)} to go.")
+
+    for i in range(0, len(todo), batch_size):
+        seqnos = todo[i:i + batch_size]
+        roots = await fetch_roots(logger, seqnos, concurrency)
+        if not roots:
+            continue
+        try:
+            # one calendar round trip for the whole batch
+            otss = await kb_ots.stamp_many([root.data_to_stamp for root in roots])
+        except kb_ots.StampError as e:
+            logger.error(f"error stamping seqnos {seqnos[0]}..{seqnos[-1]}: {e}")
+            continue
+        for root, ots in zip(roots, otss):
+            task.journal.append(journal.STAMPED, seqno=root.seqno, root=root.to_dict(), ots=ots)
+        await task.journal.commit()
+        # packed several roots to a message, paced by the chat limiter. every
+        # published root is recorded in the index, which is what makes this resumable.
+        await publish_stamped_roots(logger, bot, index, list(zip(roots, otss)))
+        await task.journal.checkpoint()
+        logger.info(f"published {len(roots)} roots through seqno {seqnos[-1]}")
+    task.journal.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="stamp and publish a range of historical merkle roots")
+    parser.add_argument('start', type=int, help="first seqno (inclusive)")
+    parser.add_argument('end', type=int, help="last seqno (inclusive)")
+    parser.add_argument('--concurrency', type=int, default=FETCH_CONCURRENCY, help="parallel keybase fetches")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="roots per calendar submission")
+    parser.add_argument('--journal', default=JOURNAL_PATH, help="where stamps are journaled until they're published")
+    args = parser.parse_args()
+    asyncio.run(backfill(args.start, args.end, args.concurrency, args.batch_size, args.journal))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import argparse
+import asyncio
+from dataclasses import dataclass, field, replace
+import importlib
+import logging
+import os
+import tempfile
+import time
+from typing import Dict, List
+
+import kb_ots
+import keybase_api
+import merkle_root
+from merkle_root import fetch_historical_merkle_root, MerkleRoot
+from proof_index import PRELIMINARY, ProofIndex, VERIFIABLE
+from rate_limit import TokenBucket
+from stand_ins import FakeBot, FakeCalendar, FakeKeybaseAPI
+import task
+
+
+# how one cycle of the bot performs at different backlogs, against the local
+# stand-ins instead of keybase.io, the calendars and the keybase binary:
+#
+#   python3 code/benchmark.py --sizes 10 1000 100000
+#
+# every stage reports throughput and p50/p99 latency per operation. the
+# numbers only mean something relative to each other, e.g. before and after
+# a change, on the same machine.
+SIZES = (10, 1000, 100000)
+FIXTURE_ROOTS = 200  # distinct signed roots to fetch and verify
+CALENDARS = 2
+# effectively unlimited, so the chat limiter doesn't dominate everything
+CHAT_RATE = 1e6
+STAGES = ('fetch', 'verify', 'stamp', 'publish', 'upgrade', 'edit')
+logger = logging.getLogger('benchmark')
+
+
+@dataclass
+class Stage:
+    name: str
+    latencies: List[float] = field(default_factory=list)  # seconds per operation
+    elapsed: float = 0.0  # wall clock for the whole stage
+
+    def percentile(self, p: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+    def report(self, size: int) -> str:
+        throughput = len(self.latencies) / self.elapsed if self.elapsed else 0.0
+        return (
+            f"{size:>8} {self.name:<8} {len(self.latencies):>8} ops "
+            f"{throughput:>10.1f}/s  p50 {self.percentile(50) * 1000:>9.2f}ms  p99 {self.percentile(99) * 1000:>9.2f}ms"
+        )
+
+
+def timed(stage: Stage, func):
+    # wraps an async function so every call adds a latency sample
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            stage.latencies.append(time.perf_counter() - start)
+    return wrapper
+
+
+def set_confirmed(calendars: List[FakeCalendar], confirmed: bool) -> None:
+    for calendar in calendars:
+        calendar.confirmed = confirmed
+
+
+async def run_stage(stage: Stage, coro) -> object:
+    start = time.perf_counter()
+    result = await coro
+    stage.elapsed += time.perf_counter() - start
+    return result
+
+
+async def bench_fetch_and_verify(api: FakeKeybaseAPI, fixture_roots: int) -> Dict[str, Stage]:
+    fetch, verify = Stage('fetch'), Stage('verify')
+    seqnos = list(range(api.first, api.first + fixture_roots))
+    api.root(seqnos[-1])  # sign them all up front so that isn't what we time
+
+    fetch_one = timed(fetch, fetch_historical_merkle_root)
+    merkle_root._verified.clear()
+    await run_stage(fetch, asyncio.gather(*[fetch_one(seqno) for seqno in seqnos]))
+
+    # verification on its own, with nothing cached
+    bodies = [(await keybase_api.get_json(merkle_root.TEMPLATE_MERKLE_URL.format(seqno=seqno))).body for seqno in seqnos]
+    merkle_root._verified.clear()
+    verify_one = timed(verify, merkle_root.verify_merkle_root_async)
+    await run_stage(verify, asyncio.gather(*[verify_one(body) for body in bodies]))
+    return {'fetch': fetch, 'verify': verify}
+
+
+async def bench_size(size: int, calendars: List[FakeCalendar], fixtures: List[MerkleRoot], workdir: str) -> Dict[str, Stage]:
+    stages = {name: Stage(name) for name in ('stamp', 'publish', 'upgrade', 'edit')}
+    bot = FakeBot()
+    index = ProofIndex(os.path.join(workdir, f"index_{size}.sqlite3"))
+    index.mark_rebuilt()
+    # make every proof due for a check the moment it's published
+    roots = [replace(fixtures[i % len(fixtures)], ctime_string=MerkleRoot.ctime_string) for i in range(size)]
+
+    set_confirmed(calendars, False)
+    stamp_one = timed(stages['stamp'], task.stamper.stamp)
+    otss = await run_stage(stages['stamp'], asyncio.gather(*[stamp_one(root.data_to_stamp) for root in roots]))
+
+    publish_one = timed(stages['publish'], task.publish_stamped_root)
+    await run_stage(stages['publish'], asyncio.gather(*[
+        publish_one(logger, bot, index, root, ots) for root, ots in zip(roots, otss)
+    ]))
+    assert index.count(PRELIMINARY) == size
+
+    # now the calendars have it in a block, and one pass should finish everything
+    set_confirmed(calendars, True)
+    kb_ots.upgrade_cache = kb_ots.UpgradeCache()
+    original_upgrade = kb_ots.upgrade
+    kb_ots.upgrade = timed(stages['upgrade'], original_upgrade)
+    bot.chat.edit = timed(stages['edit'], bot.chat.edit)
+    try:
+        start = time.perf_counter()
+        await task.update_messages(logger, bot, index)
+        elapsed = time.perf_counter() - start
+    finally:
+        kb_ots.upgrade = original_upgrade
+    # upgrades and edits interleave in one pass, so they share its wall clock
+    stages['upgrade'].elapsed = stages['edit'].elapsed = elapsed
+    if index.count(VERIFIABLE) != size:
+        logger.warning(f"only {index.count(VERIFIABLE)} of {size} proofs finished")
+    index.close()
+    return stages
+
+
+async def benchmark(sizes=SIZES, fixture_roots: int = FIXTURE_ROOTS, chat_rate: float = CHAT_RATE) -> None:
+    api = FakeKeybaseAPI(first=1, latest=fixture_roots).start().install()
+    calendars = FakeCalendar().start().install(CALENDARS)
+    task.chat_limiter = TokenBucket(rate=chat_rate, burst=chat_rate, max_rate=chat_rate)
+    # the bot loads this lazily, off the startup path. keep it out of the first publish's timing
+    importlib.import_module('pykeybasebot.types.chat1')
+    try:
+        results = await bench_fetch_and_verify(api, fixture_roots)
+        fixtures = [merkle_root.verify_merkle_root(api.root(seqno)) for seqno in range(1, fixture_roots + 1)]
+        for name in ('fetch', 'verify'):
+            print(results[name].report(fixture_roots))
+        with tempfile.TemporaryDirectory() as workdir:
+            for size in sizes:
+                stages = await bench_size(size, calendars, fixtures, workdir)
+                for name in STAGES[2:]:
+                    print(stages[name].report(size))
+    finally:
+        api.stop()
+        for c in calendars:
+            c.stop()
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description="time each stage of the bot against local stand-ins")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES), help="pending proofs per run")
+    parser.add_argument('--fixture-roots', type=int, default=FIXTURE_ROOTS, help="distinct signed roots to fetch and verify")
+    parser.add_argument('--chat-rate', type=float, default=CHAT_RATE, help="chat calls per second allowed by the limiter")
+    args = parser.parse_args()
+    asyncio.run(benchmark(args.sizes, args.fixture_roots, args.chat_rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+import argparse
+import hashlib
+import logging
+import mmap
+import os
+import struct
+from typing import BinaryIO, Callable, Optional
+
+
+HEADER_SIZE = 80
+# where in a header the merkle root lives
+MERKLE_ROOT_SLICE = slice(36, 68)
+PREV_HASH_SLICE = slice(4, 36)
+BITS_SLICE = slice(72, 76)
+# the first HEADER_SIZE bytes of the file say where the headers start:
+# this, then the first height as a little-endian uint32, then zeros
+MAGIC = b'kbmphdrs'
+# the easiest target mainnet allows (nBits 0x1d00ffff)
+POW_LIMIT = 0xffff * 256 ** (0x1d - 3)
+RETARGET_INTERVAL = 2016  # blocks
+# how far one retarget can move the target, either way
+MAX_RETARGET_FACTOR = 4
+DEFAULT_PATH = os.environ.get(
+    'BLOCK_HEADERS_PATH',
+    os.path.join(os.path.dirname(__file__), '..', 'tmp', 'block_headers.dat'),
+)
+logger = logging.getLogger(__name__)
+
+
+class HeaderSyncError(Exception):
+    pass
+
+
+class BlockHeaderStore:
+    # a run of bitcoin block headers, from first_height up, in one flat
+    # file. the header for height h is the 80 bytes after the first
+    # (h - first_height + 1) * 80, so a lookup is a slice of an mmap.
+    #
+    # every header has to build on the one before it and meet the target
+    # in its own nBits, which can only change at a retarget and then by at
+    # most MAX_RETARGET_FACTOR. the target itself isn't recomputed from
+    # timestamps, so this trusts the source to follow the most work, not
+    # to pick which chain that is. when the source's chain is longer than
+    # ours but forks from it, ours is cut back to where they agree.
+    def __init__(self, path: str = DEFAULT_PATH):
+        self.path = path
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+        self._file = open(path, 'r+b')
+        self._map: Optional[mmap.mmap] = None
+        self.first_height = 0
+        self._remap()
+
+    @property
+    def height(self) -> int:
+        # the highest height in the file, or first_height - 1 when it's empty
+        return self.first_height + max(self._size // HEADER_SIZE - 1, 0) - 1
+
+    def header(self, height: int) -> Optional[bytes]:
+        if os.fstat(self._file.fileno()).st_size != self._size:
+            # someone else (e.g. the sync cli) has appended or cut back since we mapped it
+            self._remap()
+        if height < self.first_height or height > self.height:
+            return None
+        offset = (height - self.first_height + 1) * HEADER_SIZE
+        return self._map[offset:offset + HEADER_SIZE]
+
+    def merkle_root(self, height: int) -> Optional[bytes]:
+        header = self.header(height)
+        return header[MERKLE_ROOT_SLICE] if header else None
+
+    def append(self, headers: bytes) -> int:
+        # add headers starting at height + 1. returns how many were added.
+        if len(headers) % HEADER_SIZE:
+            raise HeaderSyncError(f"got {len(headers)} bytes, which isn't a whole number of headers")
+        if not self._size:
+            self._start_at(self.first_height)
+        prev = self.header(self.height)
+        for offset in range(0, len(headers), HEADER_SIZE):
+            header = headers[offset:offset + HEADER_SIZE]
+            _check_header(self.height + 1 + offset // HEADER_SIZE, header, prev)
+            prev = header
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(headers)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._remap()
+        return len(headers) // HEADER_SIZE
+
+    def truncate(self, height: int) -> None:
+        # drop every header above height
+        if height >= self.height:
+            return
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.truncate((max(height, self.first_height - 1) - self.first_height + 2) * HEADER_SIZE)
+        os.fsync(self._file.fileno())
+        self._remap()
+
+    def sync_from_dump(self, dump: BinaryIO, first_height: int = 0, chunk_headers: int = 2016) -> int:
+        # `dump` is raw concatenated headers starting at `first_height`.
+        # anything we already have gets skipped.
+        base = dump.tell()
+        dump_height = first_height + (dump.seek(0, os.SEEK_END) - base) // HEADER_SIZE - 1
+
+        def dump_header(height: int) -> Optional[bytes]:
+            if height < first_height or height > dump_height:
+                return None
+            dump.seek(base + (height - first_height) * HEADER_SIZE)
+            return dump.read(HEADER_SIZE)
+
+        def dump_hash(height: int) -> Optional[bytes]:
+            if height == first_height - 1:
+                # the dump doesn't have it, but its first header says what it is
+                following = dump_header(first_height)
+                return following[PREV_HASH_SLICE] if following else None
+            header = dump_header(height)
+            return block_hash(header) if header else None
+
+        if self.height < self.first_height:
+            self._start_at(first_height)
+        if dump_height <= self.height:
+            logger.info(f"the dump only goes up to {dump_height}, and we have up to {self.height}")
+            return 0
+        if first_height > self.height + 1:
+            raise HeaderSyncError(f"dump starts at {first_height} but we only have up to {self.height}")
+        self.truncate(self._common_ancestor(dump_hash))
+        dump.seek(base + (self.height + 1 - first_height) * HEADER_SIZE)
+        added = 0
+        while True:
+            chunk = dump.read(chunk_headers * HEADER_SIZE)
+            if not chunk:
+                break
+            added += self.append(chunk)
+        logger.info(f"synced {added} headers from the dump, now at {self.height}")
+        return added
+
+    def sync_from_node(self, proxy=None, chunk_headers: int = 2016) -> int:
+        # `proxy` is a bitcoin.rpc.Proxy, by default configured from
+        # ~/.bitcoin/bitcoin.conf. only asks for headers we don't have yet.
+        if proxy is None:
+            import bitcoin.rpc
+            proxy = bitcoin.rpc.Proxy()
+        node_height = proxy.getblockcount()
+        if node_height <= self.height:
+            logger.info(f"the node is at {node_height}, and we have up to {self.height}")
+            return 0
+        # getblockhash is in the same byte order as block_hash
+        self.truncate(self._common_ancestor(proxy.getblockhash))
+        added = 0
+        height = self.height + 1
+        while height <= node_height:
+            last = min(node_height, height + chunk_headers - 1)
+            chunk = b''.join(
+                proxy.getblockheader(proxy.getblockhash(h)).serialize()
+                for h in range(height, last + 1)
+            )
+            added += self.append(chunk)
+            height = last + 1
+        logger.info(f"synced {added} headers from the node, now at {self.height}")
+        return added
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+    def _common_ancestor(self, source_hash: Callable[[int], Optional[bytes]]) -> int:
+        # the highest height where the source has the same header as us.
+        # usually that's our tip, unless the chain has reorganized since.
+        for height in range(self.height, self.first_height - 1, -1):
+            if source_hash(height) == block_hash(self.header(height)):
+                if height < self.height:
+                    logger.warning(f"the chain forked after {height}, dropping our headers above it")
+                return height
+        if self.height < self.first_height:
+            return self.height
+        raise HeaderSyncError(f"the source has none of our headers from {self.first_height} to {self.height}")
+
+    def _start_at(self, first_height: int) -> None:
+        # only while there are no headers yet
+        self._file.seek(0)
+        self._file.truncate(0)
+        self._file.write(_preamble(first_height))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._remap()
+
+    def _remap(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._size = os.fstat(self._file.fileno()).st_size
+        # can't mmap an empty file, but then there's nothing to read anyway
+        if self._size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            preamble = self._map[:HEADER_SIZE]
+            if not preamble.startswith(MAGIC):
+                raise HeaderSyncError(f"{self.path} isn't a header store")
+            (self.first_height,) = struct.unpack_from('<I', preamble, len(MAGIC))
+
+
+def _preamble(first_height: int) -> bytes:
+    return (MAGIC + struct.pack('<I', first_height)).ljust(HEADER_SIZE, b'\0')
+
+
+def _check_header(height: int, header: bytes, prev: Optional[bytes]) -> None:
+    # prev is None for the first header in the store
+    if prev is not None and header[PREV_HASH_SLICE] != block_hash(prev):
+        raise HeaderSyncError(f"header at height {height} doesn't build on the one before it")
+    target = bits_to_target(header[BITS_SLICE])
+    if not 0 < target <= POW_LIMIT:
+        raise HeaderSyncError(f"header at height {height} has an impossible target")
+    if int.from_bytes(block_hash(header), 'little') > target:
+        raise HeaderSyncError(f"header at height {height} doesn't meet its own target")
+    if prev is None:
+        return
+    prev_target = bits_to_target(prev[BITS_SLICE])
+    if height % RETARGET_INTERVAL:
+        if header[BITS_SLICE] != prev[BITS_SLICE]:
+            raise HeaderSyncError(f"header at height {height} changes the target between retargets")
+    elif not prev_target // MAX_RETARGET_FACTOR <= target <= prev_target * MAX_RETARGET_FACTOR:
+        raise HeaderSyncError(f"header at height {height} moves the target too far")
+
+
+def bits_to_target(bits: bytes) -> int:
+    # nBits is a compact float: the top byte is a length in bytes, the
+    # rest the leading bytes of the target. a set sign bit means negative.
+    (compact,) = struct.unpack('<I', bits)
+    exponent, mantissa = compact >> 24, compact & 0x7fffff
+    if compact & 0x800000:
+        return -1
+    if exponent <= 3:
+        return mantissa >> (8 * (3 - exponent))
+    return mantissa * 256 ** (exponent - 3)
+
+
+def block_hash(header: bytes) -> bytes:
+    return hashlib.sha256(hashlib.sha256(header).digest()).digest()
+
+
+def open_default() -> Optional[BlockHeaderStore]:
+    # only use a header store if someone has bothered to sync one
+    if not os.path.exists(DEFAULT_PATH):
+        return None
+    return BlockHeaderStore(DEFAULT_PATH)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="incrementally sync the local bitcoin block header store")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--dump', help="file of raw concatenated 80-byte headers")
+    source.add_argument('--node', action='store_true', help="a bitcoin node configured in ~/.bitcoin/bitcoin.conf")
+    parser.add_argument('--first-height', type=int, default=0, help="height of the first header in --dump")
+    parser.add_argument('--path', default=DEFAULT_PATH, help="header store file")
+    args = parser.parse_args()
+
+    store = BlockHeaderStore(args.path)
+    try:
+        if args.dump:
+            with open(args.dump, 'rb') as dump:
+                store.sync_from_dump(dump, first_height=args.first_height)
+        else:
+            store.sync_from_node()
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
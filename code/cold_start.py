@@ -0,0 +1,84 @@
+import argparse
+import compileall
+import logging
+import os
+import re
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+from merkle_root import load_verifier, VERIFIER_KEY_CACHE
+
+
+# how fast a fresh container gets going. two modes:
+#
+#   python3 code/cold_start.py --prepare   # at image build: compile the code
+#                                          # and pre-serialize keybase's key
+#   python3 code/cold_start.py             # import main.py in a fresh
+#                                          # interpreter and fail if it got slow
+#
+# the check fails if importing main.py pulls in any of DEFERRED (they're
+# loaded later, off the startup path) or takes longer than --budget. the bot
+# itself reports time to first proof as kbmp_time_to_first_proof_seconds.
+DEFERRED = ('pykeybasebot', 'pgpy')
+IMPORT_BUDGET = 0.5  # seconds for `import main`, best of RUNS
+RUNS = 5
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+logger = logging.getLogger('cold_start')
+
+
+def prepare() -> None:
+    compileall.compile_dir(CODE_DIR, quiet=1)
+    load_verifier()
+    print(f"compiled {CODE_DIR} and cached the verifier key at {VERIFIER_KEY_CACHE}")
+
+
+def profile_imports(module: str = 'main') -> Tuple[float, Dict[str, float]]:
+    # (seconds for the whole import, cumulative seconds per module imported)
+    res = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=CODE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True,
+    )
+    modules: Dict[str, float] = {}
+    for line in res.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            modules[match.group(4)] = int(match.group(2)) / 1e6
+    return modules[module], modules
+
+
+def check(budget: float = IMPORT_BUDGET, runs: int = RUNS, top: int = 10) -> bool:
+    # returns whether startup is still within budget
+    profiles = [profile_imports() for _ in range(runs)]
+    total, modules = min(profiles, key=lambda profile: profile[0])
+    print(f"import main: {total * 1000:.0f}ms (best of {runs}, budget {budget * 1000:.0f}ms)")
+    for name, seconds in sorted(modules.items(), key=lambda item: -item[1])[:top]:
+        print(f"  {seconds * 1000:7.1f}ms  {name}")
+
+    ok = True
+    eager: List[str] = sorted(name for name in modules if name.split('.')[0] in DEFERRED)
+    if eager:
+        print(f"FAIL these should only be imported after startup: {', '.join(eager)}")
+        ok = False
+    if total > budget:
+        print(f"FAIL import main took {total * 1000:.0f}ms, over the {budget * 1000:.0f}ms budget")
+        ok = False
+    return ok
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description="prepare for, or check, a fast cold start")
+    parser.add_argument('--prepare', action='store_true', help="compile the code and cache the verifier key")
+    parser.add_argument('--budget', type=float, default=IMPORT_BUDGET, help="seconds `import main` may take")
+    parser.add_argument('--runs', type=int, default=RUNS, help="fresh interpreters to time, keeping the best")
+    args = parser.parse_args()
+    if args.prepare:
+        prepare()
+        return
+    sys.exit(0 if check(args.budget, args.runs) else 1)
+
+
+if __name__ == '__main__':
+    main()
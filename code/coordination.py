@@ -0,0 +1,153 @@
+import asyncio
+import bisect
+import hashlib
+import inspect
+import json
+import logging
+import os
+import time
+from typing import Dict, Iterable, Optional
+import uuid
+
+from last_success import NAMESPACE
+
+
+# with COORDINATE_REPLICAS set, several copies of the bot can run at once,
+# logged in as the same user. they coordinate through the kvstore namespace
+# last_success already uses:
+#   * LEADER_KEY holds a lease. only the replica holding it stamps new roots.
+#   * MEMBERS_KEY holds every live replica and when its heartbeat runs out.
+#     pending proofs are split between them by consistent hashing on msg_id,
+#     so each replica upgrades and edits its own share.
+# both are only ever written with the revision keybase expects next, so two
+# replicas can't both win the same write. a replica that stops renewing
+# (i.e. it died) loses its lease and its share after LEASE_TTL, and the
+# rest pick them up. leases are in wall clock time, so replicas' clocks
+# need to roughly agree.
+ENABLED = bool(os.environ.get('COORDINATE_REPLICAS'))
+REPLICA_ID = os.environ.get('REPLICA_ID') or uuid.uuid4().hex[:12]
+LEADER_KEY = "leader"
+MEMBERS_KEY = "replicas"
+LEASE_TTL = 60  # seconds a lease or heartbeat lasts without being renewed
+RENEW_INTERVAL = LEASE_TTL / 4
+# a leader stops starting new work this long before its lease would run
+# out, so a stamp that's already underway finishes before anyone takes over
+LEASE_MARGIN = 20  # seconds
+VIRTUAL_NODES = 64  # points per replica on the hash ring
+WRITE_ATTEMPTS = 3  # tries at a compare-and-swap write before giving up until the next renewal
+logger = logging.getLogger(__name__)
+
+
+class CoordinationError(Exception):
+    pass
+
+
+class HashRing:
+    # each replica gets VIRTUAL_NODES points on a ring of 64-bit hashes, and
+    # a key belongs to the first point after its own hash. when a replica
+    # joins or leaves, only the keys next to its points move.
+    def __init__(self, replicas: Iterable[str], virtual_nodes: int = VIRTUAL_NODES):
+        self.replicas = sorted(set(replicas))
+        points = sorted(
+            (_hash(f"{replica}#{i}"), replica)
+            for replica in self.replicas for i in range(virtual_nodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [replica for _, replica in points]
+
+    def owner(self, key) -> Optional[str]:
+        if not self._hashes:
+            return None
+        i = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._owners[i]
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.sha256(value.encode()).digest()[:8], 'big')
+
+
+class Coordinator:
+    # until the first renewal gets through, it doesn't lead and owns nothing
+    def __init__(self, bot=None, replica_id: str = REPLICA_ID, ttl: float = LEASE_TTL):
+        self.bot = bot
+        self.replica_id = replica_id
+        self.ttl = ttl
+        self.lease_expires = 0.0  # unix time our leader lease runs out
+        self.ring = HashRing([])
+
+    @property
+    def team(self) -> str:
+        return f"{self.bot.username},{self.bot.username}"
+
+    @property
+    def is_leader(self) -> bool:
+        return time.time() < self.lease_expires - LEASE_MARGIN
+
+    def owns(self, msg_id) -> bool:
+        return self.ring.owner(msg_id) == self.replica_id
+
+    async def run(self, bot_ready=None):
+        # `bot_ready` is the bot, or anything that can be awaited for it
+        if bot_ready is not None:
+            self.bot = await bot_ready if inspect.isawaitable(bot_ready) else bot_ready
+        while True:
+            try:
+                await self.renew()
+            except Exception as e:
+                # keep the last ring we saw. if the lease lapses meanwhile,
+                # is_leader goes false on its own.
+                logger.error(f"couldn't renew with the other replicas: {e}")
+            await asyncio.sleep(RENEW_INTERVAL)
+
+    async def renew(self) -> None:
+        await self.heartbeat()
+        await self.lead()
+
+    async def heartbeat(self) -> None:
+        # put ourselves in the members list, drop anyone who's expired,
+        # and re-split the work between whoever's left
+        for _ in range(WRITE_ATTEMPTS):
+            res = await self.bot.kvstore.get(self.team, NAMESPACE, MEMBERS_KEY)
+            now = time.time()
+            members: Dict[str, float] = json.loads(res.entry_value) if res.entry_value else {}
+            live = {replica: expires for replica, expires in members.items() if expires > now}
+            live[self.replica_id] = now + self.ttl
+            try:
+                await self.bot.kvstore.put(self.team, NAMESPACE, MEMBERS_KEY, json.dumps(live), revision=res.revision + 1)
+            except Exception as e:
+                # someone else wrote in between. read it again.
+                logger.debug(f"members write lost a race: {e}")
+                continue
+            self._set_ring(live)
+            return
+        raise CoordinationError(f"couldn't write {MEMBERS_KEY} after {WRITE_ATTEMPTS} tries")
+
+    async def lead(self) -> None:
+        # take the leader lease if nobody holds it, or renew it if we do
+        res = await self.bot.kvstore.get(self.team, NAMESPACE, LEADER_KEY)
+        now = time.time()
+        lease = json.loads(res.entry_value) if res.entry_value else None
+        if lease and lease['replica'] != self.replica_id and lease['expires'] > now:
+            if self.lease_expires:
+                logger.info(f"{lease['replica']} is leading now")
+            self.lease_expires = 0.0
+            return
+        expires = now + self.ttl
+        try:
+            await self.bot.kvstore.put(
+                self.team, NAMESPACE, LEADER_KEY,
+                json.dumps({'replica': self.replica_id, 'expires': expires}),
+                revision=res.revision + 1,
+            )
+        except Exception as e:
+            logger.debug(f"leader write lost a race: {e}")
+            self.lease_expires = 0.0
+            return
+        if not self.lease_expires:
+            logger.info(f"{self.replica_id} is now the leader")
+        self.lease_expires = expires
+
+    def _set_ring(self, members: Dict[str, float]) -> None:
+        if sorted(members) != self.ring.replicas:
+            logger.info(f"splitting pending proofs between {len(members)} replicas: {', '.join(sorted(members))}")
+            self.ring = HashRing(members)
@@ -0,0 +1,169 @@
+import argparse
+import asyncio
+from base64 import b64encode
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from dataclasses_json import dataclass_json
+import hashlib
+import json
+import logging
+import re
+import sys
+from typing import Any, List, Tuple
+
+import keybase_api
+import metrics
+from merkle_root import VerificationError
+from proof_index import ProofIndex
+
+
+# proves that a keybase user's sigchain leaf was in the merkle tree under a
+# root we stamped, e.g.
+#
+#   python3 code/inclusion.py 9f9d4b7c8d4bd1e6bfbdb2bb37e2ed19 12345678
+#
+# keybase serves the path from the top of the tree down to the leaf that
+# holds the uid. every node on it is json, hashed with sha512:
+#   {"tab": {"<child prefix>": "<child's hash>", ...}, "type": 1}   interior
+#   {"tab": {"<uid>": <leaf>, ...}, "type": 2}                      leaf
+# the top node has to hash to the root hash in our stamped MerkleRoot, and
+# each node after it to the hash its parent has for its prefix. the result
+# comes with the ots proof for that root, so the leaf is anchored to bitcoin.
+#
+# the upper levels of the tree are the same for every uid under a root, and
+# mostly the same from one root to the next, so verified nodes are kept by
+# hash. a node that's already cached isn't hashed or parsed again, only
+# compared with what was served.
+TEMPLATE_PATH_URL = 'https://keybase.io/_/api/1.0/merkle/path.json?uid={uid}&seqno={seqno}'
+NODE_CACHE_SIZE = 65536  # verified tree nodes to remember
+INTERIOR_NODE = 1
+LEAF_NODE = 2
+UID = re.compile(r'^[0-9a-f]{32}$')
+logger = logging.getLogger(__name__)
+
+
+class InclusionError(VerificationError):
+    pass
+
+
+@dataclass_json
+@dataclass
+class PathStep:
+    prefix: str  # of the uid, "" for the top of the tree
+    hash: str  # what the parent (or the root) says this node hashes to
+    val: str  # the node's json, exactly as it was hashed
+
+
+@dataclass_json
+@dataclass
+class InclusionProof:
+    uid: str
+    seqno: int
+    root_hash: str
+    leaf: Any  # what the tree holds for the uid, as keybase serves it
+    ots: str  # base64 of the root's `.ots`
+    status: str  # of the ots proof
+    msg_id: int  # the message in the bot's channel with the stamped root
+    path: List[PathStep] = field(default_factory=list)
+
+
+# sha512 hex of a node -> its json and the json parsed. only ever holds nodes that hashed right.
+_nodes: 'OrderedDict[str, Tuple[str, dict]]' = OrderedDict()
+
+
+async def prove(index: ProofIndex, uid: str, seqno: int) -> InclusionProof:
+    uid = uid.lower()
+    if not UID.match(uid):
+        raise InclusionError(f"{uid} isn't a keybase uid")
+    proof = index.lookup(seqno)
+    if proof is None:
+        raise InclusionError(f"there's no stamped root for seqno {seqno}")
+    resp = await keybase_api.get_json(TEMPLATE_PATH_URL.format(uid=uid, seqno=seqno))
+    try:
+        served = [(step['prefix'], step['node']['val']) for step in resp.body['path']]
+    except (KeyError, TypeError) as e:
+        raise InclusionError(f"unexpected merkle path response for {uid} at {seqno}: {e!r}")
+    with metrics.timed('inclusion_verify', expected=(InclusionError,)):
+        leaf, path = verify_path(uid, proof.root.root_hash, served)
+    return InclusionProof(
+        uid=uid,
+        seqno=seqno,
+        root_hash=proof.root.root_hash,
+        leaf=leaf,
+        ots=b64encode(proof.ots).decode(),
+        status=proof.status,
+        msg_id=proof.msg_id,
+        path=path,
+    )
+
+
+def verify_path(uid: str, root_hash: str, served: List[Tuple[str, str]]) -> Tuple[Any, List[PathStep]]:
+    # served is (prefix, node json) from the top of the tree down. returns the
+    # uid's leaf and the checked path, or raises if it doesn't lead from
+    # root_hash to the leaf. the hashes in the path are the ones each node
+    # was checked against, never the server's.
+    path = []
+    expected = root_hash
+    for i, (prefix, val) in enumerate(served):
+        if not uid.startswith(prefix):
+            raise InclusionError(f"step {i} is for prefix {prefix}, which {uid} isn't under")
+        node = _node(expected, val)
+        path.append(PathStep(prefix=prefix, hash=expected, val=val))
+        tab = node.get('tab') or {}
+        if node.get('type') == LEAF_NODE:
+            if i != len(served) - 1:
+                raise InclusionError(f"step {i} is a leaf, but the path goes on")
+            if uid not in tab:
+                raise InclusionError(f"{uid} isn't in the tree under root {root_hash}")
+            return tab[uid], path
+        if i == len(served) - 1:
+            raise InclusionError(f"the path ends at an interior node, at prefix {prefix}")
+        following = served[i + 1][0]
+        if len(following) <= len(prefix) or following not in tab:
+            raise InclusionError(f"step {i} has no child at prefix {following}")
+        expected = tab[following]
+    raise InclusionError("the path is empty")
+
+
+def _node(expected_hash: str, val: str) -> dict:
+    cached = _nodes.get(expected_hash)
+    if cached is not None:
+        cached_val, node = cached
+        if val != cached_val:
+            raise InclusionError(f"a node on the path doesn't hash to {expected_hash}")
+        _nodes.move_to_end(expected_hash)
+        metrics.merkle_nodes.inc(cache='hit')
+        return node
+    metrics.merkle_nodes.inc(cache='miss')
+    if hashlib.sha512(val.encode()).hexdigest() != expected_hash:
+        raise InclusionError(f"a node on the path doesn't hash to {expected_hash}")
+    try:
+        node = json.loads(val)
+    except ValueError as e:
+        raise InclusionError(f"node {expected_hash} isn't json: {e}")
+    if not isinstance(node, dict):
+        raise InclusionError(f"node {expected_hash} isn't a tree node")
+    _nodes[expected_hash] = (val, node)
+    if len(_nodes) > NODE_CACHE_SIZE:
+        _nodes.popitem(last=False)
+    return node
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description="prove a uid's leaf was under a stamped merkle root")
+    parser.add_argument('uid', help="keybase uid, 32 hex characters")
+    parser.add_argument('seqno', type=int, help="merkle root seqno the bot has published a proof for")
+    parser.add_argument('--index', default=None, help="path to the bot's proof index")
+    args = parser.parse_args()
+    index = ProofIndex(args.index) if args.index else ProofIndex()
+    try:
+        proof = asyncio.run(prove(index, args.uid, args.seqno))
+    except (InclusionError, keybase_api.FetchError) as e:
+        print(f"FAIL {e}", file=sys.stderr)
+        sys.exit(1)
+    print(proof.to_json(indent=2))
+
+
+if __name__ == '__main__':
+    main()
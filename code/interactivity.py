@@ -1,38 +1,137 @@
 import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass, field
 import logging
 import os
-import sys
+import re
+from typing import Dict, List, Optional, TYPE_CHECKING
 
-from pykeybasebot import Bot
-import pykeybasebot.types.chat1 as chat1
+import last_success
+from merkle_root import TEMPLATE_MERKLE_URL
+from proof_index import ProofIndex
+from rate_limit import TokenBucket
 
+if TYPE_CHECKING:
+    # pykeybasebot takes most of a second to import. main.py does that on a
+    # thread while the first root is fetched and stamped, in new_bot.
+    from pykeybasebot import Bot
 
-async def handler(bot, event):
-    logger = logging.getLogger('bot_handler')
-    if event.msg.content.type_name != chat1.MessageTypeStrings.TEXT.value:
-        # not a basic chat message. bail.
-        return
-    if event.msg.sender.username == bot.username:
-        # my own message in the channel. bail.
-        return
-    channel = event.msg.channel
-    path = os.path.join(os.path.dirname(__file__), 'chat_response.txt')
-    msg = f'{open(path).read()}'.format(**locals())
-    await bot.chat.send(channel, msg)
 
-    seqno = await last_success.fetch(bot)
-    msg = f"And the last merkle root i've verified is this one: {KEYBASE_MERKLE_ROOT_URL}?seqno={seqno}"
-    await bot.chat.send(channel, msg)
-    logger.debug(f"sent a response message in {channel.name}")
+RESPONSE_PATH = os.path.join(os.path.dirname(__file__), 'chat_response.txt')
+# after the first message in a conversation, wait this long for more before
+# replying, and answer all of them at once
+COALESCE_DELAY = 2  # seconds
+# each sender gets SENDER_BURST messages answered, then one every 1/SENDER_RATE seconds
+SENDER_RATE = 1 / 30
+SENDER_BURST = 3
+MAX_SENDERS = 10000  # rate limits to remember before forgetting the quietest sender
+MAX_QUERIES = 10  # seqnos answered per reply
+# e.g. "seqno 1234?" or "what about seqno #1234"
+SEQNO_QUERY = re.compile(r'\bseqno\s*#?\s*(\d+)', re.IGNORECASE)
+logger = logging.getLogger('bot_handler')
 
 
-def new_bot() -> Bot:
+@dataclass
+class _Batch:
+    # everything asked in one conversation since its reply was scheduled
+    channel: object
+    seqnos: List[int] = field(default_factory=list)
+    intro: bool = False  # whether anything in it wasn't a seqno question
+
+
+class Responder:
+    # answers chat messages without touching the disk or the kvstore: the
+    # response is read once, the last verified seqno comes from
+    # last_success's copy, and "seqno N?" is answered from the proof index.
+    # messages that arrive close together in a conversation get one reply,
+    # and each sender is rate limited.
+    def __init__(self, index: Optional[ProofIndex] = None):
+        self.index = index
+        self._response: Optional[str] = None
+        self._batches: Dict[str, _Batch] = {}
+        self._senders: 'OrderedDict[str, TokenBucket]' = OrderedDict()
+
+    async def __call__(self, bot, event):
+        import pykeybasebot.types.chat1 as chat1
+        msg = event.msg
+        if msg.content.type_name != chat1.MessageTypeStrings.TEXT.value:
+            # not a basic chat message. bail.
+            return
+        if msg.sender.username == bot.username:
+            # my own message in the channel. bail.
+            return
+        if not self._allow(msg.sender.username):
+            logger.debug(f"{msg.sender.username} is over their rate limit - not answering")
+            return
+
+        seqnos = [int(seqno) for seqno in SEQNO_QUERY.findall(msg.content.text.body or '')]
+        batch = self._batches.get(msg.conv_id)
+        if batch is not None:
+            # a reply is already on its way. fold this message into it.
+            self._add(batch, seqnos)
+            return
+        batch = self._batches[msg.conv_id] = _Batch(channel=msg.channel)
+        self._add(batch, seqnos)
+        try:
+            await asyncio.sleep(COALESCE_DELAY)
+        finally:
+            del self._batches[msg.conv_id]
+        try:
+            await self.reply(bot, batch)
+        except Exception as e:
+            logger.error(f"error replying in {batch.channel.name}: {e}")
+
+    async def reply(self, bot, batch: _Batch) -> None:
+        from task import retry_if_timeout
+        lines = []
+        if batch.intro:
+            lines.append(self.response(bot))
+        lines.extend(self.answer(seqno) for seqno in batch.seqnos[:MAX_QUERIES])
+        seqno = last_success.latest()
+        if seqno is None:
+            # only until the first fetch. after that, updates keep it current.
+            seqno = await last_success.fetch(bot)
+        lines.append(f"And the last merkle root i've verified is this one: {TEMPLATE_MERKLE_URL.format(seqno=seqno)}")
+        await retry_if_timeout(logger, bot.chat.send, batch.channel, '\n\n'.join(lines))
+        logger.debug(f"sent a response message in {batch.channel.name}")
+
+    def response(self, bot) -> str:
+        if self._response is None:
+            with open(RESPONSE_PATH) as f:
+                self._response = f.read().format(bot=bot).strip()
+        return self._response
+
+    def answer(self, seqno: int) -> str:
+        proof = self.index.lookup(seqno) if self.index is not None else None
+        if proof is None:
+            return f"seqno {seqno}: I haven't published a proof for that one."
+        return f"seqno {seqno}: {proof.status} in message {proof.msg_id} of my public channel ({proof.root.stable_url})"
+
+    def _add(self, batch: _Batch, seqnos: List[int]) -> None:
+        if not seqnos:
+            batch.intro = True
+        for seqno in seqnos:
+            if seqno not in batch.seqnos:
+                batch.seqnos.append(seqno)
+
+    def _allow(self, sender: str) -> bool:
+        bucket = self._senders.get(sender)
+        if bucket is None:
+            bucket = self._senders[sender] = TokenBucket(rate=SENDER_RATE, burst=SENDER_BURST)
+            if len(self._senders) > MAX_SENDERS:
+                self._senders.popitem(last=False)
+        self._senders.move_to_end(sender)
+        return bucket.try_acquire()
+
+
+def new_bot(handler=None) -> 'Bot':
+    from pykeybasebot import Bot
     return Bot(
         username=os.environ["KEYBASE_USERNAME"],
         paperkey=os.environ["KEYBASE_PAPERKEY"],
-        handler=handler,
+        handler=handler or Responder(),
     )
 
-async def start_bot(bot: Bot):
+async def start_bot(bot: 'Bot'):
     listen_options = {"hide-exploding": False, "filter_channels": None}
     await bot.start(listen_options)
@@ -0,0 +1,151 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+
+# an append-only log of the steps each proof goes through, so work that's
+# done but not yet in the channel survives a restart:
+#   stamped    a root was stamped (root, ots), and is about to be published
+#   published  the message with those seqnos is in the channel and the index
+#   upgraded   a proof came back final (msg_id, seqno, ots), and is about to be edited in
+#   edited     the edit with those seqnos went out
+# a "stamped" with no "published" after it is a stamp the calendars already
+# have. an "upgraded" with no "edited" is a finished proof that never made it
+# into the channel. on startup, task.resume picks both up from there.
+#
+# records are json lines. append() only buffers. commit() writes and fsyncs
+# everything buffered, and callers that arrive while a write is underway
+# share the next one, so a burst of upgrades costs one fsync. once nothing
+# is open, checkpoint() empties the file.
+DEFAULT_PATH = os.environ.get(
+    'JOURNAL_PATH',
+    os.path.join(os.path.dirname(__file__), '..', 'tmp', 'journal.jsonl'),
+)
+logger = logging.getLogger(__name__)
+
+STAMPED = 'stamped'
+PUBLISHED = 'published'
+UPGRADED = 'upgraded'
+EDITED = 'edited'
+
+
+class Journal:
+    def __init__(self, path: str = DEFAULT_PATH):
+        self.path = path
+        # seqno -> its "stamped" record, until it's published
+        self.open_stamps: Dict[int, dict] = {}
+        # (msg_id, seqno) -> its "upgraded" record, until it's edited in
+        self.open_upgrades: Dict[Tuple[int, int], dict] = {}
+        self._buffer: List[str] = []
+        self._appended = 0  # records appended, ever
+        self._durable = 0  # how many of those are on disk
+        self._flushing: Optional[asyncio.Future] = None
+        self._load()
+        self._file = open(path, 'a')
+
+    def append(self, op: str, **fields) -> None:
+        record = dict(fields, op=op)
+        self._apply(record)
+        self._buffer.append(json.dumps(record, separators=(',', ':')) + '\n')
+        self._appended += 1
+
+    async def commit(self) -> None:
+        # returns once everything appended so far is on disk
+        target = self._appended
+        while self._durable < target:
+            if self._flushing is None:
+                lines, self._buffer = self._buffer, []
+                self._flushing = asyncio.ensure_future(self._flush(lines, self._appended))
+            await asyncio.shield(self._flushing)
+
+    async def checkpoint(self) -> None:
+        # called between cycles. writes what's buffered, or if nothing's
+        # open any more, throws the whole file away.
+        while self._flushing is not None:
+            await asyncio.shield(self._flushing)
+        if self.open_stamps or self.open_upgrades:
+            await self.commit()
+            return
+        if not self._buffer and self._file.tell() == 0:
+            return
+        self._buffer = []
+        self._flushing = asyncio.ensure_future(self._run(self._truncate, self._appended))
+        await asyncio.shield(self._flushing)
+
+    def close(self) -> None:
+        self._file.close()
+
+    async def _run(self, func, *args) -> None:
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, func, *args)
+        finally:
+            self._flushing = None
+
+    async def _flush(self, lines: List[str], durable: int) -> None:
+        try:
+            await self._run(self._write, lines, durable)
+        except Exception:
+            # they aren't on disk. put them back ahead of anything appended
+            # since, so the next commit writes them again in order.
+            self._buffer[:0] = lines
+            raise
+
+    def _write(self, lines: List[str], durable: int) -> None:
+        start = self._file.tell()
+        try:
+            self._file.write(''.join(lines))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except OSError:
+            # don't leave part of a record for the retry to be appended onto
+            try:
+                self._file.seek(start)
+                self._file.truncate(start)
+            except OSError as e:
+                logger.warning(f"couldn't cut a failed journal write back off: {e}")
+            raise
+        self._durable = durable
+
+    def _truncate(self, durable: int) -> None:
+        self._file.truncate(0)
+        self._file.seek(0)
+        os.fsync(self._file.fileno())
+        self._durable = durable
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        complete = 0  # bytes up to the end of the last whole line
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # a write cut off by the crash we're recovering from
+                    logger.warning(f"dropping a torn journal record: {line[:80]!r}")
+                    break
+                complete += len(line)
+                try:
+                    self._apply(json.loads(line))
+                except (ValueError, KeyError) as e:
+                    logger.warning(f"skipping a bad journal record: {e}")
+        if complete < os.path.getsize(self.path):
+            # cut the torn tail off, or the next record would be appended onto it
+            with open(self.path, 'r+b') as f:
+                f.truncate(complete)
+                os.fsync(f.fileno())
+        if self.open_stamps or self.open_upgrades:
+            logger.info(f"journal has {len(self.open_stamps)} unpublished stamps and {len(self.open_upgrades)} unedited upgrades")
+
+    def _apply(self, record: dict) -> None:
+        op = record['op']
+        if op == STAMPED:
+            self.open_stamps[record['seqno']] = record
+        elif op == PUBLISHED:
+            for seqno in record['seqnos']:
+                self.open_stamps.pop(seqno, None)
+        elif op == UPGRADED:
+            self.open_upgrades[(record['msg_id'], record['seqno'])] = record
+        elif op == EDITED:
+            for seqno in record['seqnos']:
+                self.open_upgrades.pop((record['msg_id'], seqno), None)
@@ -1,13 +1,35 @@
+import asyncio
 from base64 import b64decode, b64encode
+from collections import OrderedDict
+from dataclasses import dataclass, field
 import logging
 import os
-import subprocess
-from typing import Tuple
+import re
+import time
+from typing import List, Optional, Set, Tuple
 
-from opentimestamps.core.timestamp import DetachedTimestampFile
+from opentimestamps.calendar import CommitmentNotFoundError, RemoteCalendar, DEFAULT_AGGREGATORS
+from opentimestamps.core.notary import BitcoinBlockHeaderAttestation, PendingAttestation
+from opentimestamps.core.op import OpAppend, OpSHA256
+from opentimestamps.core.serialize import BytesDeserializationContext, BytesSerializationContext
+from opentimestamps.core.timestamp import DetachedTimestampFile, Timestamp, make_merkle_tree
+
+import metrics
+import workers
 
 
 EXPECTED_MAGIC_BYTES = DetachedTimestampFile.HEADER_MAGIC
+CALENDAR_URLS = DEFAULT_AGGREGATORS
+# same default as `ots stamp -m`: a stamp only counts if this many calendars took it
+MIN_CALENDAR_RESPONSES = 2
+CALENDAR_TIMEOUT = 10  # seconds
+# how long a "still pending" answer from a calendar is reused for other
+# proofs that share the same commitment
+PENDING_TTL = 60  # seconds
+# backstops for lookups whose proofs are never released, e.g. ones dropped
+# from the index. a dropped lookup is just asked for again if it's needed.
+MAX_LOOKUPS = 10000
+LOOKUP_MAX_AGE = 24 * 60 * 60  # seconds
 logger = logging.getLogger(__name__)
 
 
@@ -20,90 +42,358 @@ class UpgradeError(Exception):
 class VerifyError(Exception):
     pass
 
+class MissingHeaderError(VerifyError):
+    # the proof is complete, but we haven't synced the block it points at
+    pass
+
+
+@dataclass
+class UpgradeResult:
+    ots: str  # base64 encoded string of the bytes in the `.ots` file
+    is_final: bool
+    # set when a calendar says it's in a block and waiting on confirmations
+    confirmations_needed: Optional[int] = None
+
+
+@dataclass
+class VerifyResult:
+    # heights of the bitcoin blocks whose merkle roots this proof commits to
+    block_heights: List[int] = field(default_factory=list)
+    # whether any of those were checked against a real block header
+    bitcoin_verified: bool = False
+
+
+# set with use_block_headers. without one, verification is `--no-bitcoin`.
+header_store = None
+
+
+def use_block_headers(store) -> None:
+    global header_store
+    header_store = store
+
+
+# everything in here works on in-memory bytes. the calendar requests are
+# blocking urllib calls inside python-opentimestamps, so they get pushed
+# onto the default executor to keep the event loop free.
+
+async def stamp(raw_data) -> str:
+    (ots,) = await stamp_many([raw_data])
+    return ots
+
+
+async def stamp_many(raw_datas: List[bytes]) -> List[str]:
+    # build a local merkle tree over everything and only send its tip to the
+    # calendars. each resulting `.ots` carries its own path up to that tip, so
+    # one calendar round trip covers the whole batch.
+    detached_files = []
+    leaves = []
+    for raw_data in raw_datas:
+        detached = DetachedTimestampFile(OpSHA256(), Timestamp(OpSHA256()(raw_data)))
+        # like `ots stamp`, add a nonce so the calendars (and anyone reading a
+        # sibling's proof) can't tell what else was in the batch
+        nonced = detached.timestamp.ops.add(OpAppend(os.urandom(16)))
+        leaves.append(nonced.ops.add(OpSHA256()))
+        detached_files.append(detached)
+
+    tip = make_merkle_tree(leaves)
+    with metrics.timed('stamp'):
+        await _submit_to_calendars(tip)
+    return [b64encode(serialize(detached)).decode('UTF-8') for detached in detached_files]
 
-async def stamp(raw_data):
-    result = subprocess.run(['ots', '-v', 'stamp'], input=raw_data, capture_output=True)
-    if result.returncode is not 0:
-        raise StampError(f"STAMP returned something non-zero {result}")
 
-    if result.stdout[:len(EXPECTED_MAGIC_BYTES)] != EXPECTED_MAGIC_BYTES:
-        raise StampError(f"STAMP magic bytes don't match: {result.stdout}")
+class BatchStamper:
+    # collects digests from anywhere in the bot (new roots, backfills, ...)
+    # and stamps them together. a digest waits at most `max_delay` seconds
+    # for company before its batch goes out.
+    def __init__(self, max_delay: float = 1.0, max_batch: int = 1024):
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self._pending: List[Tuple[bytes, asyncio.Future]] = []
+        self._timer: Optional[asyncio.Task] = None
 
-    return b64encode(result.stdout).decode('UTF-8')
+    async def stamp(self, raw_data) -> str:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((raw_data, future))
+        if len(self._pending) >= self.max_batch:
+            asyncio.ensure_future(self.flush())
+        elif self._timer is None:
+            self._timer = asyncio.ensure_future(self._flush_later())
+        return await future
 
+    async def _flush_later(self):
+        await asyncio.sleep(self.max_delay)
+        self._timer = None
+        await self.flush()
 
-async def upgrade(identifier, raw_data, ots_data) -> Tuple[str, bool]:
+    async def flush(self):
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        logger.debug(f"stamping a batch of {len(batch)}")
+        try:
+            results = await stamp_many([raw_data for raw_data, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), ots in zip(batch, results):
+            if not future.done():
+                future.set_result(ots)
+
+
+async def _submit_to_calendars(tip: Timestamp) -> None:
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(
+        *[loop.run_in_executor(None, _submit, url, tip.msg) for url in CALENDAR_URLS],
+        return_exceptions=True,
+    )
+    successes = 0
+    for url, result in zip(CALENDAR_URLS, results):
+        if isinstance(result, Exception):
+            logger.debug(f"calendar {url} did not accept the stamp: {result!r}")
+            continue
+        tip.merge(result)
+        successes += 1
+    if successes < MIN_CALENDAR_RESPONSES:
+        raise StampError(f"only {successes} of {len(CALENDAR_URLS)} calendars accepted the stamp")
+
+
+def _submit(calendar_url, digest) -> Timestamp:
+    return RemoteCalendar(calendar_url).submit(digest, timeout=CALENDAR_TIMEOUT)
+
+
+async def upgrade(identifier, raw_data, ots_data) -> UpgradeResult:
     # is the result of upgrading the OTS and whether or not it's finalized
-    # uses temp files because ots doesn't handle streams well for
-    # the `upgrade` and `verify` and `info` commands
-    tmpdir = f"../tmp"
-    data_path = os.path.join(tmpdir, str(identifier))
-    ots_path = f"{data_path}.ots"
-    bak_path = f"{ots_path}.bak"
+    detached = deserialize(ots_data)
+    _check_digest(identifier, raw_data, detached)
+
+    confirmations_needed = None
+    if not is_complete(detached.timestamp):
+        confirmations_needed = await _upgrade_pending(identifier, detached.timestamp)
+
+    if not is_complete(detached.timestamp):
+        return UpgradeResult(
+            ots=b64encode(serialize(detached)).decode('UTF-8'),
+            is_final=False,
+            confirmations_needed=confirmations_needed,
+        )
 
     try:
-        with open(data_path, 'wb') as f:
-            f.write(raw_data)
-        with open(ots_path, 'wb') as f:
-            f.write(ots_data)
-
-        ots_data, is_final = await _upgrade(logger, identifier, data_path, ots_path)
-        return ots_data, is_final
-
-    finally:
-        safe_delete(data_path)
-        safe_delete(bak_path)
-        safe_delete(ots_path)
-
-
-async def _upgrade(logger, identifier, data_path, ots_path) -> Tuple[str, bool]:
-    with open(ots_path, 'rb') as f:
-        original_ots_data = f.read()
-
-    result = subprocess.run(['ots', 'upgrade', ots_path], capture_output=True)
-    if not_on_chain_yet(result):
-        return original_ots_data, False
-    if result.returncode != 0:
-        raise UpgradeError(f'unexpected result {result}')
-
-    logger.debug(f"ots upgrade result for {identifier}: {result}")
-    with open(ots_path, 'rb') as f:
-        upgraded_data = f.read()
-
-    if upgraded_data == original_ots_data:
-        # Nothing actually changed. That's weird and I don't think it should happen.
-        raise UpgradeError(f"{identifier} ots data didn't change after an upgrade")
-
-    result = subprocess.run(
-        ['ots', '--no-cache', '--no-bitcoin', '-v', 'verify', ots_path],
-        capture_output=True)
-    if not successfully_verified(result):
-        logger.debug(f'{identifier} did not verify')
-        # uncomment these lines if something is broken. otherwise, it's spammy.
-        # result = subprocess.run(['ots', 'info', ots_path], capture_output=True)
-        # logger.debug(f"INFO {result}")
-        # logger.debug(f"ots data after upgrade: {upgraded_data}")
-        raise VerifyError(f"{identifier}: {result}")
-
-    ots = b64encode(upgraded_data).decode('UTF-8')
-    return ots, True
-
-
-def safe_delete(path):
-    try:
-        os.remove(path)
-    except FileNotFoundError:
-        pass
-
-def not_on_chain_yet(ots_upgrade_result):
-    return (
-        b"Pending confirmation in Bitcoin blockchain" in ots_upgrade_result.stderr or
-        b"waiting for 5 confirmations" in ots_upgrade_result.stderr
+        with metrics.timed('verify', expected=(MissingHeaderError,)):
+            # hashing all the way up every path is pure cpu, so it goes to the workers
+            result = await workers.run(check, identifier, raw_data, serialize(detached))
+    except MissingHeaderError as e:
+        # on chain, but we can't check it until the header store catches up
+        logger.info(f"{identifier} {e}")
+        return UpgradeResult(ots=b64encode(serialize(detached)).decode('UTF-8'), is_final=False)
+    upgrade_cache.release(identifier)
+    logger.debug(f"{identifier} verified in bitcoin blocks {result.block_heights}")
+    return UpgradeResult(ots=b64encode(serialize(detached)).decode('UTF-8'), is_final=True)
+
+
+async def _upgrade_pending(identifier, timestamp: Timestamp) -> Optional[int]:
+    # ask every calendar that gave us a pending attestation whether it has
+    # made it into a block yet. merges anything new into `timestamp`, and
+    # returns the fewest confirmations any calendar said it's still waiting on.
+    pending = [
+        (sub_stamp, attestation.uri)
+        for sub_stamp in _directly_attested(timestamp)
+        for attestation in sub_stamp.attestations
+        if isinstance(attestation, PendingAttestation)
+    ]
+    results = await asyncio.gather(
+        *[upgrade_cache.get_timestamp(identifier, uri, sub_stamp.msg) for sub_stamp, uri in pending],
+        return_exceptions=True,
     )
 
+    existing_attestations = _attestations(timestamp)
+    confirmations_needed = None
+    for (sub_stamp, uri), result in zip(pending, results):
+        if isinstance(result, CommitmentNotFoundError):
+            logger.debug(f"{identifier} not on chain yet according to {uri}: {result.reason}")
+            waiting = _confirmations_needed(result.reason)
+            if waiting is not None:
+                confirmations_needed = min(waiting, confirmations_needed or waiting)
+            continue
+        if isinstance(result, Exception):
+            logger.debug(f"{identifier} error upgrading from {uri}: {result!r}")
+            continue
+        new_attestations = _attestations(result) - existing_attestations
+        if new_attestations:
+            sub_stamp.merge(result)
+            existing_attestations.update(new_attestations)
+    return confirmations_needed
+
+
+def _confirmations_needed(reason: str) -> Optional[int]:
+    # e.g. "Pending confirmation in Bitcoin blockchain" vs
+    # "Timestamp in block 123 waiting for 5 confirmations"
+    match = re.search(r'waiting for (\d+) confirmations', reason or '')
+    return int(match.group(1)) if match else None
+
+
+def _get_timestamp(calendar_url, commitment) -> Timestamp:
+    return RemoteCalendar(calendar_url).get_timestamp(commitment, timeout=CALENDAR_TIMEOUT)
 
-def successfully_verified(ots_verify_result):
-    return (
-        b'Success! Timestamp complete' in ots_verify_result.stderr or
-        b'To verify manually, check that Bitcoin block' in ots_verify_result.stderr
+
+async def _lookup_timestamp(calendar_url, commitment) -> Timestamp:
+    loop = asyncio.get_running_loop()
+    # "not on chain yet" is the normal answer, not an error
+    with metrics.timed('calendar_upgrade', expected=(CommitmentNotFoundError,)):
+        return await loop.run_in_executor(None, _get_timestamp, calendar_url, commitment)
+
+
+@dataclass
+class _Lookup:
+    future: asyncio.Future
+    started: float
+    dependents: Set = field(default_factory=set)
+
+    def is_stale(self, now) -> bool:
+        if not self.future.done():
+            return False
+        if self.future.cancelled():
+            return True
+        error = self.future.exception()
+        if error is None:
+            # the calendar gave us its attestation. that won't change.
+            return False
+        if isinstance(error, CommitmentNotFoundError):
+            return now - self.started > PENDING_TTL
+        # network trouble or similar - try again next time
+        return True
+
+
+class UpgradeCache:
+    # proofs stamped in the same batch (or the same calendar aggregation
+    # window) share a commitment on each calendar. this makes sure each
+    # (calendar, commitment) is only asked about once, and hands the answer
+    # to every proof that needs it. an entry is dropped once every proof
+    # that depended on it has been released as final, or once it's older
+    # than LOOKUP_MAX_AGE or one of the oldest past MAX_LOOKUPS.
+    def __init__(self):
+        # oldest first
+        self._lookups: 'OrderedDict[Tuple[str, bytes], _Lookup]' = OrderedDict()
+
+    async def get_timestamp(self, identifier, calendar_url, commitment) -> Timestamp:
+        key = (calendar_url, commitment)
+        lookup = self._lookups.get(key)
+        now = time.monotonic()
+        if lookup is None or lookup.is_stale(now):
+            future = asyncio.ensure_future(_lookup_timestamp(calendar_url, commitment))
+            lookup = _Lookup(
+                future=future,
+                started=now,
+                dependents=lookup.dependents if lookup else set(),
+            )
+            self._lookups[key] = lookup
+            self._lookups.move_to_end(key)
+            self._expire(now)
+        lookup.dependents.add(identifier)
+        # shield so one caller getting cancelled doesn't cancel it for everyone
+        return await asyncio.shield(lookup.future)
+
+    def release(self, identifier) -> None:
+        for key, lookup in list(self._lookups.items()):
+            lookup.dependents.discard(identifier)
+            if not lookup.dependents:
+                del self._lookups[key]
+
+    def _expire(self, now) -> None:
+        while self._lookups:
+            key, oldest = next(iter(self._lookups.items()))
+            if len(self._lookups) <= MAX_LOOKUPS and now - oldest.started <= LOOKUP_MAX_AGE:
+                break
+            del self._lookups[key]
+
+    def __len__(self):
+        return len(self._lookups)
+
+
+upgrade_cache = UpgradeCache()
+
+
+async def verify(identifier, raw_data, ots_data) -> VerifyResult:
+    result = await workers.run(check, identifier, raw_data, ots_data)
+    if result is None:
+        raise VerifyError(f"{identifier}: no bitcoin attestations in the proof")
+    return result
+
+
+def check(identifier, raw_data, ots_data) -> Optional[VerifyResult]:
+    # verify without an event loop, e.g. in a worker process. returns None
+    # for a proof that's for the right data but isn't on chain yet.
+    detached = deserialize(ots_data)
+    _check_digest(identifier, raw_data, detached)
+    if not is_complete(detached.timestamp):
+        return None
+    return _verify(identifier, raw_data, detached)
+
+
+def _verify(identifier, raw_data, detached: DetachedTimestampFile) -> VerifyResult:
+    # the proof has to commit to our data and end in at least one bitcoin
+    # block header attestation. with a header store, each attestation's
+    # digest has to be the merkle root of the block at that height.
+    # without one, this is the same as `ots --no-bitcoin verify`.
+    attested = [
+        (msg, attestation.height)
+        for msg, attestation in detached.timestamp.all_attestations()
+        if isinstance(attestation, BitcoinBlockHeaderAttestation)
+    ]
+    if not attested:
+        raise VerifyError(f"{identifier}: no bitcoin attestations in the proof")
+    heights = sorted(height for _, height in attested)
+    if header_store is None:
+        return VerifyResult(block_heights=heights)
+
+    verified = False
+    for msg, height in attested:
+        merkle_root = header_store.merkle_root(height)
+        if merkle_root is None:
+            continue
+        if merkle_root != msg:
+            raise VerifyError(f"{identifier}: attestation doesn't match the merkle root of block {height}")
+        verified = True
+    if not verified:
+        raise MissingHeaderError(f"is waiting for headers at {heights} (have up to {header_store.height})")
+    return VerifyResult(block_heights=heights, bitcoin_verified=True)
+
+
+def _check_digest(identifier, raw_data, detached: DetachedTimestampFile) -> None:
+    if detached.file_hash_op(raw_data) != detached.file_digest:
+        raise VerifyError(f"{identifier}: ots proof is for different data")
+
+
+def is_complete(timestamp: Timestamp) -> bool:
+    return any(
+        isinstance(attestation, BitcoinBlockHeaderAttestation)
+        for _, attestation in timestamp.all_attestations()
     )
+
+
+def _directly_attested(timestamp: Timestamp):
+    # every sub-timestamp that carries attestations of its own
+    if timestamp.attestations:
+        yield timestamp
+    for sub_stamp in timestamp.ops.values():
+        yield from _directly_attested(sub_stamp)
+
+
+def _attestations(timestamp: Timestamp) -> set:
+    return set(attestation for _, attestation in timestamp.all_attestations())
+
+
+def serialize(detached: DetachedTimestampFile) -> bytes:
+    ctx = BytesSerializationContext()
+    detached.serialize(ctx)
+    return ctx.getbytes()
+
+
+def deserialize(ots_data: bytes) -> DetachedTimestampFile:
+    if ots_data[:len(EXPECTED_MAGIC_BYTES)] != EXPECTED_MAGIC_BYTES:
+        raise UpgradeError(f"ots magic bytes don't match: {ots_data}")
+    try:
+        return DetachedTimestampFile.deserialize(BytesDeserializationContext(ots_data))
+    except Exception as e:
+        raise UpgradeError(f"ots data doesn't deserialize: {e}")
@@ -0,0 +1,75 @@
+import asyncio
+from dataclasses import dataclass
+import logging
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+
+REQUEST_TIMEOUT = (5, 30)  # seconds to connect, seconds to read
+# urllib3 sleeps backoff_factor * 2^(attempt - 1) between attempts
+RETRIES = Retry(
+    total=5,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+)
+POOL_SIZE = 8
+logger = logging.getLogger(__name__)
+
+_session: Optional[requests.Session] = None
+
+
+class FetchError(Exception):
+    pass
+
+
+@dataclass
+class Response:
+    status: int
+    body: Optional[dict] = None  # None when the server said 304 Not Modified
+    etag: Optional[str] = None
+
+    @property
+    def not_modified(self) -> bool:
+        return self.status == 304
+
+
+def session() -> requests.Session:
+    # one session for the life of the process so TLS connections to
+    # keybase.io get reused instead of renegotiated on every fetch
+    global _session
+    if _session is None:
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=RETRIES)
+        _session = requests.Session()
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+    return _session
+
+
+async def get_json(url, etag=None) -> Response:
+    # requests is blocking, so it runs on the default executor
+    loop = asyncio.get_running_loop()
+    with metrics.timed('fetch'):
+        return await loop.run_in_executor(None, fetch_json, url, etag)
+
+
+def fetch_json(url, etag=None) -> Response:
+    headers = {'If-None-Match': etag} if etag else {}
+    try:
+        resp = session().get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    except requests.RequestException as e:
+        raise FetchError(f"GET {url} failed: {e}")
+
+    if resp.status_code == 304:
+        return Response(status=304, etag=etag)
+    if resp.status_code != 200:
+        raise FetchError(f"GET {url} returned {resp.status_code}")
+    try:
+        body = resp.json()
+    except ValueError as e:
+        raise FetchError(f"GET {url} didn't return json: {e}")
+    return Response(status=resp.status_code, body=body, etag=resp.headers.get('ETag'))
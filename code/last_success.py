@@ -1,33 +1,83 @@
 import logging
+from typing import Optional
+
+import metrics
 
 
 NAMESPACE = "keybase_merkle_prover"
 ENTRY_KEY = "last_successful_verification"
 logger = logging.getLogger(__name__)
 
+# the newest seqno we know is in the kvstore, so readers like the chat
+# responder don't need a round trip. None until the first fetch or update.
+_latest: Optional[int] = None
+# the newest seqno recorded since the last flush
+_pending: Optional[int] = None
+# the entry's revision and value as of our last read or write of it. a put
+# with the next revision only goes through if nobody else wrote since, so
+# there's no need to read it first.
+_revision: Optional[int] = None
+_written = 0
+
+
+def latest() -> Optional[int]:
+    return _latest
+
 
-async def update(bot, seqno) -> None:
+def record(seqno) -> None:
+    # note a verified seqno. it's written by the next flush.
+    global _latest, _pending
+    _pending = max(_pending or 0, seqno)
+    _latest = max(_latest or 0, seqno)
+
+
+async def flush(bot) -> None:
+    # one kvstore write for everything recorded since the last flush
+    global _pending, _revision, _written, _latest
+    if _pending is None:
+        return
+    seqno, _pending = _pending, None
+    if seqno <= _written:
+        return
     team_name = f"{bot.username},{bot.username}"
     try:
+        if _revision is not None:
+            try:
+                with metrics.timed('kvstore_put'):
+                    await bot.kvstore.put(team_name, NAMESPACE, ENTRY_KEY, str(seqno), revision=_revision + 1)
+                _revision, _written = _revision + 1, seqno
+                return
+            except Exception as e:
+                # someone else wrote it since. read it and try again.
+                logger.debug(f"kvstore revision moved on: {e}")
         res = await bot.kvstore.get(team_name, NAMESPACE, ENTRY_KEY)
         prev_seqno = int(res.entry_value or 0)
+        _revision, _written = res.revision, prev_seqno
         if seqno > prev_seqno:
             # don't overwrite if I wind up doing these things out of order
-            await bot.kvstore.put(team_name, NAMESPACE, ENTRY_KEY, str(seqno))
+            with metrics.timed('kvstore_put'):
+                await bot.kvstore.put(team_name, NAMESPACE, ENTRY_KEY, str(seqno), revision=_revision + 1)
+            _revision, _written = _revision + 1, seqno
         else:
             logger.debug(f"verified a seqno out of order. not updating from {str(prev_seqno)} to {seqno}")
+            _latest = max(_latest or 0, prev_seqno)
     except Exception as e:
         # this functionality is entirely a nice-to-have, so I don't
-        # really care if it errors
+        # really care if it errors. try again next flush.
+        _revision = None
+        _pending = max(_pending or 0, seqno)
         logger.error(f"kvstore update error: {e}")
     return
 
 
 async def fetch(bot) -> int:
+    global _latest, _revision, _written
     team_name = f"{bot.username},{bot.username}"
     try:
         res = await bot.kvstore.get(team_name, NAMESPACE, ENTRY_KEY)
         seqno = int(res.entry_value or 0)
+        _latest = max(_latest or 0, seqno)
+        _revision, _written = res.revision, seqno
     except Exception as e:
         # this functionality is entirely a nice-to-have, so I don't
         # really care if it errors
@@ -2,51 +2,109 @@ import asyncio
 import logging
 import os
 import sys
+import time
+from typing import Awaitable, TYPE_CHECKING
 
-from pykeybasebot import Bot
-
-from interactivity import new_bot, start_bot
+import block_headers
+import coordination
+from interactivity import new_bot, Responder, start_bot
+from journal import Journal
+import kb_ots
 import last_success
-from merkle_root import KEYBASE_MERKLE_ROOT_URL
-from task import broadcast_new_root, update_messages
+import metrics
+from merkle_root import KEYBASE_MERKLE_ROOT_URL, load_verifier
+from proof_index import ProofIndex, SNAPSHOT_PATH
+from root_chain import ChainVerifier
+import scheduler
+import task
+from task import broadcast_new_root, catch_up, rebuild_index, resume, update_messages
+import workers
+
+if TYPE_CHECKING:
+    from pykeybasebot import Bot
 
 
 logging.basicConfig(
     level=logging.DEBUG,
     format='%(asctime)s | %(levelname)s | %(name)s -- %(message)s',
 )
-NEW_ROOT_INTERVAL = 20 * 60  # every 20 minutes
-ON_CHAIN_UPDATE_INTERVAL = 1 * 60  # every minute
+SNAPSHOT_INTERVAL = 60 * 60  # how often to copy the proof index to PROOF_INDEX_SNAPSHOT
 
 
 ################################
 
 # loops for two-stage OTS proofs
 
-async def new_proof_loop(bot: Bot):
+async def new_proof_loop(bot_ready: 'Awaitable[Bot]', index: ProofIndex, index_ready: asyncio.Event, coordinator: coordination.Coordinator = None):
     logger = logging.getLogger('new_proof')
+    chain = ChainVerifier(index)
+    # poll for new roots as often as keybase makes them, not on a fixed interval
+    cadence = scheduler.RootCadence()
     while True:
-        logger.debug("ready to broadcast a new root")
-        await broadcast_new_root(logger, bot)
-        await asyncio.sleep(NEW_ROOT_INTERVAL)
+        if coordinator is not None and not coordinator.is_leader:
+            logger.debug("another replica is leading - not stamping this one")
+        else:
+            with metrics.cycle('new_root'):
+                await broadcast_new_root(logger, bot_ready, index, chain, cadence, index_ready)
+        await asyncio.sleep(cadence.next_poll())
 
-async def update_proof_loop(bot: Bot):
+async def update_proof_loop(bot_ready: 'Awaitable[Bot]', index: ProofIndex, index_ready: asyncio.Event, coordinator: coordination.Coordinator = None):
     logger = logging.getLogger('update_proof')
+    bot = await bot_ready
+    if index.needs_rebuild:
+        await rebuild_index(logger, bot, index)
+    await resume(logger, bot, index)
+    # the index knows everything that's been published. new roots can go out.
+    index_ready.set()
+    snapshot_at = time.time()
     while True:
         logger.debug("+ loop starting")
-        await update_messages(logger, bot)
-        logger.debug(f"- loop complete - sleeping {ON_CHAIN_UPDATE_INTERVAL} seconds")
-        await asyncio.sleep(ON_CHAIN_UPDATE_INTERVAL)
+        with metrics.cycle('update'):
+            if not index.needs_rebuild:
+                # pick up what other replicas (or a backfill) published and edited
+                await catch_up(logger, bot, index)
+            await update_messages(logger, bot, index, coordinator.owns if coordinator is not None else None)
+        if SNAPSHOT_PATH and time.time() - snapshot_at >= SNAPSHOT_INTERVAL:
+            index.snapshot(SNAPSHOT_PATH)
+            snapshot_at = time.time()
+            logger.debug(f"copied the proof index to {SNAPSHOT_PATH}")
+        # sleep until the next proof is due, not on a fixed interval
+        sleep_for = scheduler.loop_sleep(index.next_due())
+        logger.debug(f"- loop complete - sleeping {int(sleep_for)} seconds")
+        await asyncio.sleep(sleep_for)
 
 ################################
 
 # run everything
+async def run_bot(bot_ready: 'Awaitable[Bot]'):
+    await start_bot(await bot_ready)
+
 async def do_it():
-    bot = new_bot()
+    metrics.serve()
+    index = ProofIndex()
+    index.restore()
+    task.use_journal(Journal())
+    load_verifier()
+    kb_ots.use_block_headers(block_headers.open_default())
+    # fork the workers before pykeybasebot is loaded, so they don't carry it
+    workers.start()
+    # pykeybasebot is most of the startup time. it loads on a thread while
+    # the first root is fetched and verified.
+    bot_ready = asyncio.get_running_loop().run_in_executor(None, new_bot, Responder(index))
+    index_ready = asyncio.Event()
+    loops = []
+    coordinator = None
+    if coordination.ENABLED:
+        # it joins the others once the bot is up. until then this replica
+        # doesn't stamp or upgrade anything.
+        coordinator = coordination.Coordinator()
+        loops.append(coordinator.run(bot_ready))
     await asyncio.gather(
-        start_bot(bot),
-        new_proof_loop(bot),
-        update_proof_loop(bot),
+        run_bot(bot_ready),
+        new_proof_loop(bot_ready, index, index_ready, coordinator),
+        update_proof_loop(bot_ready, index, index_ready, coordinator),
+        *loops,
     )
 
-asyncio.run(do_it())
+if __name__ == '__main__':
+    asyncio.run(do_it())
@@ -1,20 +1,45 @@
 from base64 import b64decode, b64encode
+from collections import OrderedDict
 from contextlib import redirect_stderr
 from dataclasses_json import dataclass_json
 from dataclasses import dataclass
+from datetime import datetime, timezone
 import hashlib
 import io
 import json
 import logging
+import os
 import re
+from typing import Optional, Tuple, TYPE_CHECKING
 
-from pgpy import PGPKey, PGPMessage
-import requests
+import keybase_api
+import metrics
+import workers
+
+if TYPE_CHECKING:
+    # pgpy is only imported once there's a key to load. see load_verifier
+    from pgpy import PGPKey
 
 
 KEYBASE_MERKLE_ROOT_URL = 'https://keybase.io/_/api/1.0/merkle/root.json'
 TEMPLATE_MERKLE_URL = KEYBASE_MERKLE_ROOT_URL + "?seqno={seqno}"
 KEYBASE_KID = '010159baae6c7d43c66adf8fb7bb2b8b4cbe408c062cfc369e693ccb18f85631dbcd0a'
+# how many verified signatures to remember
+VERIFIED_CACHE_SIZE = 4096
+# keybase's key, already de-armored, so a cold start skips the base64 and
+# checksum work. written the first time the key is parsed (or at image build)
+# and only used if it holds exactly the keys below.
+VERIFIER_KEY_CACHE = os.environ.get(
+    'VERIFIER_KEY_CACHE',
+    os.path.join(os.path.dirname(__file__), '..', 'tmp', 'verifier_key.bin'),
+)
+# fingerprints of keybase's merkle key and its subkeys, as published at
+# https://keybase.io/docs/server_security/our_merkle_key
+KEYBASE_KEY_FINGERPRINTS = frozenset({
+    '03E146CDAF8136680AD566912A32340CEC8C9492',
+    '307BC124E498350024F761DC8A01CE578080955B',
+    '38B848EDBAB432EBDF478992F43803A349DA99D5',
+})
 logger = logging.getLogger(__name__)
 
 
@@ -37,12 +62,102 @@ class MerkleRoot:
     def data_to_stamp(self) -> bytes:
         return b64decode(self.b64stamped)
 
+    @property
+    def ctime(self) -> float:
+        # seconds since the epoch
+        parsed = datetime.strptime(self.ctime_string, "%Y-%m-%dT%H:%M:%S.%fZ")
+        return parsed.replace(tzinfo=timezone.utc).timestamp()
+
+
+# the newest root we've verified, the ETag keybase served it with, and the
+# payload json keybase signed for it
+_latest_etag: Optional[str] = None
+_latest_root: Optional[MerkleRoot] = None
+_latest_payload_json: Optional[str] = None
+
 
 # fetch from the keybase API and verify a bunch of things
-def fetch_keybase_merkle_root() -> MerkleRoot:
-    # fetch the current merkle root from the keybase api
-    resp = requests.get(KEYBASE_MERKLE_ROOT_URL)
-    full_kb_merkle_root = resp.json()
+async def fetch_keybase_merkle_root() -> MerkleRoot:
+    global _latest_etag, _latest_root, _latest_payload_json
+    # fetch the current merkle root from the keybase api. if it hasn't
+    # changed since last time, skip downloading and verifying it again.
+    resp = await keybase_api.get_json(KEYBASE_MERKLE_ROOT_URL, etag=_latest_etag if _latest_root else None)
+    if resp.not_modified and _latest_root is not None:
+        logger.debug(f"merkle root not modified since {_latest_root.seqno}")
+        return _latest_root
+    full_kb_merkle_root = resp.body
+    if _latest_root is not None and _is_same_root(full_kb_merkle_root, _latest_root):
+        logger.debug(f"merkle root still at {_latest_root.seqno}")
+        _latest_etag = resp.etag
+        return _latest_root
+
+    merkle_root, payload_json = await verify_signed_merkle_root_async(full_kb_merkle_root)
+    _latest_etag, _latest_root, _latest_payload_json = resp.etag, merkle_root, payload_json
+    return merkle_root
+
+
+def signed_payload(merkle_root: MerkleRoot) -> Optional[str]:
+    # the payload json keybase signed for `merkle_root`, if it's the newest
+    # one fetched, so the root chain doesn't have to download it again
+    if _latest_root is not None and _latest_root == merkle_root:
+        return _latest_payload_json
+    return None
+
+
+async def fetch_historical_merkle_root(seqno: int) -> MerkleRoot:
+    # a specific seqno never changes, so there's nothing to short-circuit
+    resp = await keybase_api.get_json(TEMPLATE_MERKLE_URL.format(seqno=seqno))
+    merkle_root = await verify_merkle_root_async(resp.body)
+    if merkle_root.seqno != seqno:
+        raise VerificationError(f"asked for seqno {seqno} and got {merkle_root.seqno}")
+    return merkle_root
+
+
+def _is_same_root(full_kb_merkle_root, merkle_root: MerkleRoot) -> bool:
+    # cheap probe: same seqno and byte-for-byte the same signature we already verified
+    try:
+        raw_pgp_sig_msg = full_kb_merkle_root['sigs'][KEYBASE_KID]['sig']
+    except (KeyError, TypeError):
+        return False
+    return (
+        full_kb_merkle_root.get('seqno') == merkle_root.seqno and
+        _hash_sig(raw_pgp_sig_msg) == merkle_root.b64stamped
+    )
+
+
+def _hash_sig(raw_pgp_sig_msg) -> str:
+    # the message itself is too big to include with OTS data in a chat message
+    # so let's take the hash of it and use that instead. this is kind of a
+    # bummer because it's almost OK to use the whole thing.
+    hash_of_raw_pgp_sig = hashlib.sha512(raw_pgp_sig_msg.encode()).digest()
+    return b64encode(hash_of_raw_pgp_sig).decode('utf-8')
+
+
+def verify_merkle_root(full_kb_merkle_root) -> MerkleRoot:
+    merkle_root, _ = verify_signed_merkle_root(full_kb_merkle_root)
+    return merkle_root
+
+
+async def verify_merkle_root_async(full_kb_merkle_root) -> MerkleRoot:
+    merkle_root, _ = await verify_signed_merkle_root_async(full_kb_merkle_root)
+    return merkle_root
+
+
+async def verify_signed_merkle_root_async(full_kb_merkle_root) -> Tuple[MerkleRoot, str]:
+    # the same checks, with the RSA part done on the worker pool. once the
+    # signature's in the cache, everything else is cheap enough to do here.
+    raw_pgp_sig_msg = full_kb_merkle_root['sigs'][KEYBASE_KID]['sig']
+    sig_hash = _hash_sig(raw_pgp_sig_msg)
+    if sig_hash not in _verified:
+        with metrics.timed('pgp_verify'):
+            subject = await workers.run(verify_signature, raw_pgp_sig_msg)
+        _remember(sig_hash, subject)
+    return verify_signed_merkle_root(full_kb_merkle_root)
+
+
+def verify_signed_merkle_root(full_kb_merkle_root) -> Tuple[MerkleRoot, str]:
+    # returns the verified root along with the exact payload json keybase
+    # signed. everything in here is synchronous and doesn't touch the network
     seqno = full_kb_merkle_root['seqno']
     stable_url = TEMPLATE_MERKLE_URL.format(seqno=seqno)
     root_hash = full_kb_merkle_root['hash']
@@ -50,14 +165,11 @@ def fetch_keybase_merkle_root() -> MerkleRoot:
     # extract the signature and signed payload into a PGP message for verification
     raw_pgp_sig_msg = full_kb_merkle_root['sigs'][KEYBASE_KID]['sig']
 
-    # the message itself is too big to include with OTS data in a chat message
-    # so let's take the hash of it and use that instead. this is kind of a
-    # bummer because it's almost OK to use the whole thing.
-    hash_of_raw_pgp_sig = hashlib.sha512(raw_pgp_sig_msg.encode()).digest()
-    b64stamped = b64encode(hash_of_raw_pgp_sig).decode('utf-8')
+    b64stamped = _hash_sig(raw_pgp_sig_msg)
 
     # this function will raise an exception if PGP verification fails
-    signed_payload = _verify_keybase_signature(raw_pgp_sig_msg)
+    signed_payload_json = _verified_subject(raw_pgp_sig_msg, sig_hash=b64stamped)
+    signed_payload = json.loads(signed_payload_json)
 
     # as a sanity check, ensure that the signed payload matches
     # the raw json payload which is also present in the keybase
@@ -75,36 +187,123 @@ def fetch_keybase_merkle_root() -> MerkleRoot:
         logger.error(f"signed_payload: {signed_payload}")
         raise VerificationError(f"keybase signed a different root hash ({signed_root_hash}) from the one in the payload {root_hash}")
 
-    return MerkleRoot(
+    merkle_root = MerkleRoot(
         seqno=seqno,
         root_hash=root_hash,
         ctime_string=full_kb_merkle_root['ctime_string'],
         b64stamped=b64stamped,
         stable_url=stable_url,
     )
+    return merkle_root, signed_payload_json
+
+
+@dataclass(frozen=True)
+class SignatureVerifier:
+    # keybase's merkle signing key, parsed once and never touched again
+    key: 'PGPKey'
+
+    @classmethod
+    def from_armored(cls, armored_key: str) -> 'SignatureVerifier':
+        from pgpy import PGPKey
+        key, _ = PGPKey.from_blob(armored_key)
+        return cls(key=key)
+
+    @classmethod
+    def from_cache(cls, armored_key: str, fingerprints: frozenset, path: str = VERIFIER_KEY_CACHE) -> 'SignatureVerifier':
+        # anyone who can write the cache could put their own key in it, so
+        # what's loaded has to be exactly the pinned keys. anything else
+        # (including a copy of a key keybase has since replaced) is ignored.
+        from pgpy import PGPKey
+        try:
+            with open(path, 'rb') as f:
+                key, _ = PGPKey.from_blob(f.read())
+            if _fingerprints(key) == fingerprints:
+                return cls(key=key)
+            logger.warning(f"ignoring the verifier key at {path}, it isn't the pinned key")
+        except Exception as e:
+            # missing, or unreadable. either way, parse the armored one
+            logger.debug(f"couldn't load the verifier key from {path}: {e}")
+        verifier = cls.from_armored(armored_key)
+        if _fingerprints(verifier.key) != fingerprints:
+            raise VerificationError("the armored verifier key isn't the pinned key")
+        try:
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(bytes(verifier.key))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.debug(f"couldn't cache the verifier key at {path}: {e}")
+        return verifier
+
+    def verify(self, raw_pgp_sig_msg) -> str:
+        # returns the signed subject (a json string) or raises
+        # load the raw pgp message
+        from pgpy import PGPMessage
+        pgp_msg = PGPMessage.from_blob(raw_pgp_sig_msg)
+
+        # verify it: https://pgpy.readthedocs.io/en/latest/examples.html#verifying-things
+        f = io.StringIO()
+        with redirect_stderr(f):
+            # suppress unnecessary stdout
+            verification_result = self.key.verify(pgp_msg)
+        if not verification_result:
+            raise VerificationError("API response did not verify with Keybase's public key")
 
+        good_signatures = list(verification_result.good_signatures)
+        if len(good_signatures) != 1:
+            logger.error(f"good_signatures = {good_signatures}")
+            raise VerificationError(f"Expected 1 valid signature, got {len(good_signatures)}")
 
-def _verify_keybase_signature(raw_pgp_sig_msg):
-    # load the raw pgp message
-    pgp_msg = PGPMessage.from_blob(raw_pgp_sig_msg)
-    # load keybase's claimed public key
+        return str(good_signatures[0].subject)
+
+
+def _fingerprints(key: 'PGPKey') -> frozenset:
+    return frozenset(str(k.fingerprint) for k in (key, *key.subkeys.values()))
+
+
+_verifier: Optional[SignatureVerifier] = None
+# the armored key _verifier was loaded from. None means keybase's.
+verifier_key: Optional[str] = None
+# b64 sha512 of a raw signature -> the subject it verified to. a signature
+# that verified once will verify again, so there's no need to redo the RSA.
+_verified: 'OrderedDict[str, str]' = OrderedDict()
+
+
+def load_verifier(armored_key: str = None) -> SignatureVerifier:
+    # call at startup so the first root doesn't pay for parsing the key
+    global _verifier, verifier_key
     # see: https://keybase.io/docs/server_security/our_merkle_key
-    kb_public_key, _ = PGPKey.from_blob(KEYBASE_PGP_VERIFICATION_KEY)
-
-    # verify it: https://pgpy.readthedocs.io/en/latest/examples.html#verifying-things
-    f = io.StringIO()
-    with redirect_stderr(f):
-        # suppress unnecessary stdout
-        verification_result = kb_public_key.verify(pgp_msg)
-    if not verification_result:
-        raise VerificationError("API response did not verify with Keybase's public key")
-
-    good_signatures = list(verification_result.good_signatures)
-    if len(good_signatures) != 1:
-        logger.error(f"good_signatures = {good_signatures}")
-        raise VerificationError(f"Expected 1 valid signature, got {len(good_signatures)} from {specific_url}")
-
-    return json.loads(good_signatures[0].subject)
+    if armored_key is None:
+        _verifier = SignatureVerifier.from_cache(KEYBASE_PGP_VERIFICATION_KEY, KEYBASE_KEY_FINGERPRINTS)
+    else:
+        _verifier = SignatureVerifier.from_armored(armored_key)
+    verifier_key = armored_key
+    _verified.clear()
+    return _verifier
+
+
+def _verified_subject(raw_pgp_sig_msg, sig_hash: str = None) -> str:
+    sig_hash = sig_hash or _hash_sig(raw_pgp_sig_msg)
+    subject = _verified.get(sig_hash)
+    if subject is not None:
+        _verified.move_to_end(sig_hash)
+    else:
+        with metrics.timed('pgp_verify'):
+            subject = verify_signature(raw_pgp_sig_msg)
+        _remember(sig_hash, subject)
+    return subject
+
+
+def verify_signature(raw_pgp_sig_msg) -> str:
+    # module level so it can run on the worker pool
+    return (_verifier or load_verifier()).verify(raw_pgp_sig_msg)
+
+
+def _remember(sig_hash: str, subject: str) -> None:
+    _verified[sig_hash] = subject
+    _verified.move_to_end(sig_hash)
+    if len(_verified) > VERIFIED_CACHE_SIZE:
+        _verified.popitem(last=False)
 
 
 
@@ -0,0 +1,297 @@
+from collections import deque
+from contextlib import contextmanager
+import contextvars
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import threading
+import time
+from typing import Deque, Dict, List, Optional, Tuple
+
+
+# counters, gauges and latency histograms for every stage of the pipeline,
+# served in the prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics.
+# with TRACE_CYCLES set, each loop cycle also records a trace of the stages
+# it ran, and the last few are served as json on /traces.
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9464))  # 0 turns the endpoint off
+TRACE_CYCLES = bool(os.environ.get('TRACE_CYCLES'))
+TRACE_HISTORY = 50  # how many finished cycle traces to keep
+# seconds. calendar lookups and chat retries can take a while.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+logger = logging.getLogger(__name__)
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _label_text(self, key: Tuple[str, ...], extra: str = '') -> str:
+        pairs = [f'{label}="{value}"' for label, value in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        # an unlabelled series exists from the start so scrapes see a 0
+        self._values: Dict[Tuple[str, ...], float] = {} if labels else {(): 0}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            return [f"{self.name}{self._label_text(key)} {value}" for key, value in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        # an unlabelled series exists from the start so scrapes see a 0
+        self._values: Dict[Tuple[str, ...], float] = {} if labels else {(): 0}
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            return [f"{self.name}{self._label_text(key)} {value}" for key, value in sorted(self._values.items())]
+
+
+@dataclass
+class _Buckets:
+    counts: List[int]
+    total: float = 0.0
+    count: int = 0
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self._values: Dict[Tuple[str, ...], _Buckets] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = _Buckets(counts=[0] * len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series.counts[i] += 1
+            series.total += value
+            series.count += 1
+
+    def _samples(self):
+        lines = []
+        with self._lock:
+            for key, series in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, series.counts):
+                    le = self._label_text(key, 'le="%s"' % bound)
+                    lines.append(f"{self.name}_bucket{le} {count}")
+                le = self._label_text(key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{le} {series.count}")
+                lines.append(f"{self.name}_sum{self._label_text(key)} {series.total}")
+                lines.append(f"{self.name}_count{self._label_text(key)} {series.count}")
+        return lines
+
+
+_registry: List[_Metric] = []
+
+stage_seconds = Histogram('kbmp_stage_seconds', "time spent in each stage of the pipeline", ('stage',))
+stage_errors = Counter('kbmp_stage_errors_total', "stage calls that raised", ('stage',))
+chat_retries = Counter('kbmp_chat_retries_total', "chat api calls retried after a timeout")
+pending_proofs = Gauge('kbmp_pending_proofs', "PRELIMINARY proofs waiting to be upgraded")
+oldest_pending_age = Gauge('kbmp_oldest_pending_age_seconds', "age of the oldest PRELIMINARY proof's merkle root")
+cycle_seconds = Histogram('kbmp_cycle_seconds', "time spent in one pass of each loop", ('loop',))
+root_interval = Gauge('kbmp_root_interval_seconds', "running average of the time between keybase's merkle roots")
+merkle_nodes = Counter('kbmp_merkle_nodes_total', "merkle tree nodes checked for inclusion proofs, by whether they were already cached", ('cache',))
+time_to_first_proof = Gauge('kbmp_time_to_first_proof_seconds', "from process start to the first proof published (0 until then)")
+
+
+################################
+
+# tracing
+
+@dataclass
+class Span:
+    name: str
+    start: float  # seconds since the cycle started
+    duration: float = 0.0
+    error: Optional[str] = None
+
+
+@dataclass
+class Trace:
+    loop: str
+    started_at: float  # unix time
+    duration: float = 0.0
+    spans: List[Span] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        return {
+            'loop': self.loop,
+            'started_at': self.started_at,
+            'duration': self.duration,
+            'spans': [span.__dict__ for span in self.spans],
+        }
+
+
+# the trace for the cycle we're in. tasks gathered inside a cycle inherit it.
+_current_trace: 'contextvars.ContextVar[Optional[Trace]]' = contextvars.ContextVar('current_trace', default=None)
+_traces: Deque[Trace] = deque(maxlen=TRACE_HISTORY)
+
+
+@contextmanager
+def cycle(loop: str):
+    # wrap one pass of a loop. always times it, and traces it with TRACE_CYCLES.
+    trace = Trace(loop=loop, started_at=time.time()) if TRACE_CYCLES else None
+    token = _current_trace.set(trace)
+    start = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        elapsed = time.perf_counter() - start
+        _current_trace.reset(token)
+        cycle_seconds.observe(elapsed, loop=loop)
+        if trace is not None:
+            trace.duration = elapsed
+            _traces.append(trace)
+
+
+@contextmanager
+def timed(stage: str, expected: Tuple[type, ...] = ()):
+    # times whatever runs inside it as `stage`, sync or awaited. exceptions
+    # in `expected` (e.g. "not on chain yet") don't count as errors.
+    trace = _current_trace.get()
+    start = time.perf_counter()
+    span = Span(name=stage, start=time.time() - trace.started_at) if trace is not None else None
+    try:
+        yield
+    except expected:
+        raise
+    except Exception as e:
+        stage_errors.inc(stage=stage)
+        if span is not None:
+            span.error = repr(e)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, stage=stage)
+        if span is not None:
+            span.duration = elapsed
+            trace.spans.append(span)
+
+
+def record_backlog(pending: int, oldest_ctime: Optional[float]) -> None:
+    # set from the event loop after each update pass. the proof index's
+    # sqlite connection belongs to that thread, so scrapes can't read it.
+    pending_proofs.set(pending)
+    oldest_pending_age.set(max(0.0, time.time() - oldest_ctime) if oldest_ctime is not None else 0.0)
+
+
+def process_started() -> float:
+    # unix time the process started, so interpreter startup and imports
+    # count too. from /proc on linux, otherwise when this module loaded.
+    try:
+        with open('/proc/self/stat') as f:
+            # fields after the ")" that ends the command name. starttime is the 22nd field overall.
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return _loaded_at
+
+
+_loaded_at = time.time()
+_first_proof_at: Optional[float] = None
+
+
+def record_first_proof() -> None:
+    # called after every publish. only the first one per process counts.
+    global _first_proof_at
+    if _first_proof_at is not None:
+        return
+    _first_proof_at = time.time()
+    elapsed = _first_proof_at - process_started()
+    time_to_first_proof.set(elapsed)
+    logger.info(f"first proof published {elapsed:.2f}s after startup")
+
+
+def render() -> str:
+    return '\n'.join(line for metric in _registry for line in metric.render()) + '\n'
+
+
+def traces() -> List[dict]:
+    return [trace.to_dict() for trace in list(_traces)]
+
+
+################################
+
+# endpoint
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = render().encode(), 'text/plain; version=0.0.4'
+        elif self.path == '/traces':
+            body, content_type = json.dumps(traces()).encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(host: str = METRICS_HOST, port: int = METRICS_PORT) -> Optional[ThreadingHTTPServer]:
+    # serves /metrics (and /traces) from a daemon thread until the process exits
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
@@ -0,0 +1,299 @@
+from dataclasses import dataclass
+import logging
+import os
+import sqlite3
+import time
+from typing import Dict, List, Optional, Set
+
+from merkle_root import MerkleRoot
+
+
+DEFAULT_PATH = os.environ.get(
+    'PROOF_INDEX_PATH',
+    os.path.join(os.path.dirname(__file__), '..', 'tmp', 'proof_index.sqlite3'),
+)
+# a copy of the index that outlives the container (e.g. on a mounted volume),
+# so a fresh one starts from it instead of re-reading the whole channel
+SNAPSHOT_PATH = os.environ.get('PROOF_INDEX_SNAPSHOT')
+logger = logging.getLogger(__name__)
+
+# statuses match task.StampStatus values. a row is "pending" until it's VERIFIABLE.
+PRELIMINARY = "PRELIMINARY"
+VERIFIABLE = "VERIFIABLE"
+
+# columns added after the first version of the table: name -> definition
+MIGRATIONS = {
+    'attempts': "INTEGER NOT NULL DEFAULT 0",
+    'version': "INTEGER NOT NULL DEFAULT 0",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS proofs (
+    msg_id INTEGER NOT NULL,
+    seqno INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    ots BLOB NOT NULL,
+    root TEXT NOT NULL,
+    next_check REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    version INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (msg_id, seqno)
+);
+CREATE INDEX IF NOT EXISTS proofs_by_next_check ON proofs (status, next_check);
+CREATE TABLE IF NOT EXISTS copies (
+    msg_id INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    copy_msg_id INTEGER NOT NULL,
+    PRIMARY KEY (msg_id, channel)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+@dataclass
+class IndexedProof:
+    msg_id: int
+    root: MerkleRoot
+    ots: bytes  # raw bytes of the `.ots` file
+    status: str
+    next_check: float = 0.0
+    attempts: int = 0  # how many times we've checked it and found it still pending
+    version: int = 0  # wire format of the message it's in
+
+
+class ProofIndex:
+    # a local record of every proof we've published, so the update loop only
+    # has to look at the ones that still need upgrading instead of re-reading
+    # and re-parsing the channel every time.
+    def __init__(self, path: str = DEFAULT_PATH):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self._migrate()
+
+    @property
+    def needs_rebuild(self) -> bool:
+        # true for a brand new index, or one whose last rebuild never finished,
+        # or one restored from a snapshot that hasn't caught up yet
+        return self.get_meta('rebuilt_at') is None or self.catch_up_after is not None
+
+    @property
+    def catch_up_after(self) -> Optional[int]:
+        # after a restore, the newest message the snapshot already has.
+        # anything in the channel after it still needs reading.
+        value = self.get_meta('catch_up_after')
+        return int(value) if value is not None else None
+
+    @property
+    def seen_through(self) -> Optional[int]:
+        # the newest message in the channel that's been read into the index
+        value = self.get_meta('seen_through')
+        return int(value) if value is not None else None
+
+    def mark_rebuilt(self) -> None:
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rebuilt_at', ?)", (str(time.time()),))
+            self.db.execute("DELETE FROM meta WHERE key = 'catch_up_after'")
+
+    def restore(self, snapshot_path: Optional[str] = SNAPSHOT_PATH) -> bool:
+        # seed a brand new index from a snapshot. returns whether it did.
+        if not snapshot_path or not os.path.exists(snapshot_path) or not self.needs_rebuild:
+            return False
+        source = sqlite3.connect(f"file:{snapshot_path}?mode=ro", uri=True)
+        try:
+            source.backup(self.db)
+        finally:
+            source.close()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self._migrate()
+        if self.get_meta('rebuilt_at') is not None:
+            # a complete snapshot only needs what was published since
+            (newest,) = self.db.execute("SELECT MAX(msg_id) FROM proofs").fetchone()
+            self.set_meta('catch_up_after', str(newest or 0))
+        logger.info(f"restored the proof index from {snapshot_path}")
+        return True
+
+    def snapshot(self, snapshot_path: str) -> None:
+        # a consistent copy of the whole index, swapped in all at once.
+        # rollback journal rather than WAL, so it's a single file that can
+        # sit on a network volume.
+        tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+        dest = sqlite3.connect(tmp_path)
+        try:
+            self.db.backup(dest)
+            dest.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            dest.close()
+        os.replace(tmp_path, snapshot_path)
+
+    def record(self, msg_id: int, root: MerkleRoot, ots: bytes, status: str, next_check: float = 0.0, version: int = 0) -> None:
+        # never let an older PRELIMINARY copy overwrite a VERIFIABLE one.
+        # next_check only applies to a new row. a proof that's already
+        # indexed keeps its place in the backoff schedule.
+        with self.db:
+            self.db.execute(
+                """
+                INSERT INTO proofs (msg_id, seqno, status, ots, root, next_check, version)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (msg_id, seqno) DO UPDATE SET
+                    status = excluded.status,
+                    ots = excluded.ots,
+                    root = excluded.root,
+                    version = excluded.version
+                WHERE proofs.status != ? OR excluded.status = ?
+                """,
+                (msg_id, root.seqno, status, ots, root.to_json(), next_check, version, VERIFIABLE, VERIFIABLE),
+            )
+
+    def forget(self, msg_id: int, seqnos: List[int]) -> None:
+        # these roots have moved out of msg_id into another message
+        with self.db:
+            self.db.executemany(
+                "DELETE FROM proofs WHERE msg_id = ? AND seqno = ?",
+                [(msg_id, seqno) for seqno in seqnos],
+            )
+
+    def reschedule(self, msg_id: int, seqno: int, next_check: float) -> None:
+        # called after a check came back pending
+        with self.db:
+            self.db.execute(
+                "UPDATE proofs SET next_check = ?, attempts = attempts + 1 WHERE msg_id = ? AND seqno = ?",
+                (next_check, msg_id, seqno),
+            )
+
+    def postpone(self, proofs: List[IndexedProof], next_check: float) -> None:
+        # look at these again later, without counting it as a check
+        with self.db:
+            self.db.executemany(
+                "UPDATE proofs SET next_check = MAX(next_check, ?) WHERE msg_id = ? AND seqno = ?",
+                [(next_check, proof.msg_id, proof.root.seqno) for proof in proofs],
+            )
+
+    def next_due(self) -> Optional[float]:
+        # the soonest next_check of any pending proof. the index on
+        # (status, next_check) makes this a cheap priority-queue peek.
+        (due,) = self.db.execute(
+            "SELECT MIN(next_check) FROM proofs WHERE status = ?", (PRELIMINARY,)
+        ).fetchone()
+        return due
+
+    def pending(self, now: Optional[float] = None, limit: int = -1) -> List[IndexedProof]:
+        # PRELIMINARY proofs that are due for a check, oldest first
+        now = time.time() if now is None else now
+        rows = self.db.execute(
+            """
+            SELECT msg_id, root, ots, status, next_check, attempts, version FROM proofs
+            WHERE status = ? AND next_check <= ?
+            ORDER BY next_check, msg_id
+            LIMIT ?
+            """,
+            (PRELIMINARY, now, limit),
+        )
+        return [_to_proof(row) for row in rows]
+
+    def oldest_pending(self) -> Optional[IndexedProof]:
+        # the PRELIMINARY proof with the lowest seqno, i.e. the oldest root
+        row = self.db.execute(
+            """
+            SELECT msg_id, root, ots, status, next_check, attempts, version FROM proofs
+            WHERE status = ?
+            ORDER BY seqno
+            LIMIT 1
+            """,
+            (PRELIMINARY,),
+        ).fetchone()
+        return _to_proof(row) if row else None
+
+    def message(self, msg_id: int) -> List[IndexedProof]:
+        # every root in one chat message, in the order they appear in it
+        rows = self.db.execute(
+            """
+            SELECT msg_id, root, ots, status, next_check, attempts, version FROM proofs
+            WHERE msg_id = ?
+            ORDER BY seqno
+            """,
+            (msg_id,),
+        )
+        return [_to_proof(row) for row in rows]
+
+    def lookup(self, seqno: int) -> Optional[IndexedProof]:
+        # the best copy of one seqno: VERIFIABLE if there is one, else the newest
+        row = self.db.execute(
+            """
+            SELECT msg_id, root, ots, status, next_check, attempts, version FROM proofs
+            WHERE seqno = ?
+            ORDER BY status = ? DESC, msg_id DESC
+            LIMIT 1
+            """,
+            (seqno, VERIFIABLE),
+        ).fetchone()
+        return _to_proof(row) if row else None
+
+    def record_copy(self, msg_id: int, channel: str, copy_msg_id: int) -> None:
+        # msg_id is the message in the bot's own channel. `channel` is the
+        # "team#channel" the copy went to, and copy_msg_id is its id there.
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO copies (msg_id, channel, copy_msg_id) VALUES (?, ?, ?)",
+                (msg_id, channel, copy_msg_id),
+            )
+
+    def copies(self, msg_id: int) -> Dict[str, int]:
+        # channel -> copy_msg_id for every copy of one message
+        rows = self.db.execute("SELECT channel, copy_msg_id FROM copies WHERE msg_id = ?", (msg_id,))
+        return dict(rows.fetchall())
+
+    def newest_copy(self, channel: str) -> Optional[int]:
+        (newest,) = self.db.execute("SELECT MAX(copy_msg_id) FROM copies WHERE channel = ?", (channel,)).fetchone()
+        return newest
+
+    def published_seqnos(self, start: int, end: int) -> Set[int]:
+        # every seqno in [start, end] that we've already sent to the channel
+        rows = self.db.execute(
+            "SELECT DISTINCT seqno FROM proofs WHERE seqno BETWEEN ? AND ?", (start, end)
+        )
+        return {seqno for (seqno,) in rows}
+
+    def newest_holder(self, seqno: int) -> Optional[int]:
+        # the newest message with this seqno in it
+        (msg_id,) = self.db.execute("SELECT MAX(msg_id) FROM proofs WHERE seqno = ?", (seqno,)).fetchone()
+        return msg_id
+
+    def count(self, status: str) -> int:
+        (n,) = self.db.execute("SELECT COUNT(*) FROM proofs WHERE status = ?", (status,)).fetchone()
+        return n
+
+    def close(self) -> None:
+        self.db.close()
+
+    def _migrate(self) -> None:
+        existing = {row[1] for row in self.db.execute("PRAGMA table_info(proofs)")}
+        with self.db:
+            for column, definition in MIGRATIONS.items():
+                if column not in existing:
+                    self.db.execute(f"ALTER TABLE proofs ADD COLUMN {column} {definition}")
+
+    def get_meta(self, key) -> Optional[str]:
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value) -> None:
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+
+def _to_proof(row) -> IndexedProof:
+    msg_id, root, ots, status, next_check, attempts, version = row
+    return IndexedProof(
+        msg_id=msg_id,
+        root=MerkleRoot.from_json(root),
+        ots=bytes(ots),
+        status=status,
+        next_check=next_check,
+        attempts=attempts,
+        version=version,
+    )
@@ -0,0 +1,54 @@
+import asyncio
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    # paces calls to something that falls over when pushed too hard (the
+    # keybase chat api). the rate halves every time a call times out and
+    # creeps back up with every success.
+    #
+    # acquire() takes its token before it awaits anything, so concurrent
+    # callers queue up behind each other without needing a lock.
+    def __init__(self, rate: float = 2.0, burst: float = 2.0, min_rate: float = 0.1, max_rate: float = 10.0):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        self._refill()
+        self._tokens -= 1
+        if self._tokens < 0:
+            # we're in debt. wait until our token would have been minted.
+            await asyncio.sleep(-self._tokens / self.rate)
+
+    def try_acquire(self) -> bool:
+        # take a token if there's one right now, without waiting or going into debt
+        self._refill()
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def wait_time(self) -> float:
+        # seconds until try_acquire would succeed
+        self._refill()
+        return max(0.0, (1 - self._tokens) / self.rate)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def on_success(self) -> None:
+        self.rate = min(self.max_rate, self.rate + 0.1)
+
+    def on_timeout(self) -> None:
+        self.rate = max(self.min_rate, self.rate / 2)
+        logger.debug(f"backing off to {self.rate:.2f} calls/second")
@@ -0,0 +1,159 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import hashlib
+import json
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+import keybase_api
+from merkle_root import MerkleRoot, signed_payload, TEMPLATE_MERKLE_URL, verify_signed_merkle_root_async
+
+
+# how many verified links to keep around for later walks
+LINK_CACHE_SIZE = 1024
+TIP_META_KEY = 'chain_tip'
+logger = logging.getLogger(__name__)
+
+
+class ChainError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class RootLink:
+    # the parts of a verified root that other roots point back at
+    seqno: int
+    prev: Optional[str]  # long hash of the previous root's payload
+    skips: Dict[int, str]  # seqno -> short hash of that root's payload
+    short_hash: str
+    long_hash: str
+
+    @classmethod
+    def from_payload_json(cls, payload_json: str) -> 'RootLink':
+        body = json.loads(payload_json)['body']
+        # keybase hashes the exact signed payload: sha256 for skip pointers
+        # and sha512 for `prev`
+        return cls(
+            seqno=body['seqno'],
+            prev=body.get('prev'),
+            skips={int(seqno): h for seqno, h in (body.get('skips') or {}).items()},
+            short_hash=hashlib.sha256(payload_json.encode()).hexdigest(),
+            long_hash=hashlib.sha512(payload_json.encode()).hexdigest(),
+        )
+
+    def to_json(self) -> str:
+        return json.dumps({
+            'seqno': self.seqno,
+            'prev': self.prev,
+            'skips': self.skips,
+            'short_hash': self.short_hash,
+            'long_hash': self.long_hash,
+        })
+
+    @classmethod
+    def from_json(cls, raw: str) -> 'RootLink':
+        d = json.loads(raw)
+        d['skips'] = {int(seqno): h for seqno, h in d['skips'].items()}
+        return cls(**d)
+
+
+async def fetch_link(seqno: int) -> RootLink:
+    resp = await keybase_api.get_json(TEMPLATE_MERKLE_URL.format(seqno=seqno))
+    merkle_root, payload_json = await verify_signed_merkle_root_async(resp.body)
+    if merkle_root.seqno != seqno:
+        raise ChainError(f"asked for seqno {seqno} and got {merkle_root.seqno}")
+    return RootLink.from_payload_json(payload_json)
+
+
+class ChainVerifier:
+    # keeps the newest root we've verified and makes sure every new root
+    # points back to it. gaps get walked through the skip pointers, which
+    # roughly halve the distance each hop, so it's O(log n) fetches instead
+    # of fetching every seqno in between.
+    def __init__(self, index=None, fetch: Callable[[int], Awaitable[RootLink]] = fetch_link):
+        self.index = index  # a ProofIndex to persist the tip in, if any
+        self.fetch = fetch
+        self._links: 'OrderedDict[int, RootLink]' = OrderedDict()
+        self.tip: Optional[RootLink] = None
+        if index is not None:
+            raw_tip = index.get_meta(TIP_META_KEY)
+            if raw_tip:
+                self.tip = RootLink.from_json(raw_tip)
+                self._remember(self.tip)
+
+    async def verify(self, merkle_root: MerkleRoot) -> int:
+        # raises ChainError if `merkle_root` doesn't descend from the tip.
+        # returns how many extra roots had to be fetched.
+        link = self._links.get(merkle_root.seqno)
+        hops = 0
+        if link is None:
+            # the root was just fetched and its signature checked, so its
+            # payload is already at hand. only hops in between get fetched.
+            payload_json = signed_payload(merkle_root)
+            if payload_json is not None:
+                link = RootLink.from_payload_json(payload_json)
+            else:
+                link = await self.fetch(merkle_root.seqno)
+                hops += 1
+        hops += await self.extend(link)
+        return hops
+
+    async def extend(self, link: RootLink) -> int:
+        if self.tip is None:
+            # trust on first use
+            logger.info(f"starting the root chain at {link.seqno}")
+            self._set_tip(link)
+            return 0
+        if link.seqno < self.tip.seqno:
+            raise ChainError(f"root went backwards from {self.tip.seqno} to {link.seqno}")
+        if link.seqno == self.tip.seqno:
+            if link.short_hash != self.tip.short_hash:
+                raise ChainError(f"two different roots for seqno {link.seqno}")
+            return 0
+
+        hops = await self._walk(link, self.tip)
+        logger.debug(f"root {link.seqno} links back to {self.tip.seqno} in {hops} fetches")
+        self._set_tip(link)
+        return hops
+
+    async def _walk(self, newer: RootLink, target: RootLink) -> int:
+        hops = 0
+        current = newer
+        while True:
+            self._remember(current)
+            if target.seqno in current.skips:
+                if current.skips[target.seqno] != target.short_hash:
+                    raise ChainError(f"{current.seqno} skips to a different {target.seqno}")
+                return hops
+            if current.seqno - 1 == target.seqno:
+                if current.prev != target.long_hash:
+                    raise ChainError(f"{current.seqno} has a different prev than {target.seqno}")
+                return hops
+
+            # hop to the furthest-back root we can reach without overshooting
+            candidates = [seqno for seqno in current.skips if target.seqno < seqno < current.seqno]
+            next_seqno = min(candidates) if candidates else current.seqno - 1
+            next_link = self._links.get(next_seqno)
+            if next_link is None:
+                next_link = await self.fetch(next_seqno)
+                hops += 1
+
+            if next_seqno in current.skips:
+                expected, actual = current.skips[next_seqno], next_link.short_hash
+            else:
+                expected, actual = current.prev, next_link.long_hash
+            if expected != actual:
+                raise ChainError(f"{current.seqno} doesn't point at the {next_seqno} keybase served")
+            current = next_link
+
+    def _set_tip(self, link: RootLink) -> None:
+        self.tip = link
+        self._remember(link)
+        if self.index is not None:
+            self.index.set_meta(TIP_META_KEY, link.to_json())
+
+    def _remember(self, link: RootLink) -> None:
+        self._links[link.seqno] = link
+        self._links.move_to_end(link.seqno)
+        if len(self._links) > LINK_CACHE_SIZE:
+            self._links.popitem(last=False)
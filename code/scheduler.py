@@ -0,0 +1,122 @@
+import logging
+import os
+import time
+from typing import List, Optional, Set
+
+from merkle_root import MerkleRoot
+import metrics
+from rate_limit import TokenBucket
+
+
+# calendars aggregate for a while and then wait for a block, so nothing
+# stamped less than this long ago has any chance of being on chain yet
+FIRST_CHECK_DELAY = 60 * 60
+# after that, back off from this...
+BASE_BACKOFF = 5 * 60
+# ...up to this, doubling on every check that comes back pending
+MAX_BACKOFF = 2 * 60 * 60
+# once a calendar says it's in a block, it's roughly this long per confirmation
+SECONDS_PER_CONFIRMATION = 10 * 60
+# bounds on how long the update loop sleeps between passes. the upper one
+# matters because new proofs can show up in the index while we're asleep.
+MIN_LOOP_SLEEP = 5
+MAX_LOOP_SLEEP = 10 * 60
+# the new root loop polls keybase (cheap, it's a conditional GET) this soon
+# after the next root is expected, but never more or less often than these
+MIN_ROOT_POLL = 15
+MAX_ROOT_POLL = 5 * 60
+ROOT_POLL_SLACK = 5  # seconds after a root is expected before looking for it
+# calendar submissions for new roots. every root seen while waiting for one
+# goes out in the same submission.
+STAMPS_PER_HOUR = float(os.environ.get('NEW_ROOT_STAMPS_PER_HOUR', 12))
+STAMP_BURST = 2
+ROOT_RATE_SMOOTHING = 0.2  # weight of the newest gap between roots in the running average
+logger = logging.getLogger(__name__)
+
+
+def first_check(root: MerkleRoot, now: Optional[float] = None) -> float:
+    now = time.time() if now is None else now
+    return max(now, root.ctime + FIRST_CHECK_DELAY)
+
+
+def next_check(root: MerkleRoot, attempts: int, confirmations_needed: Optional[int] = None, now: Optional[float] = None) -> float:
+    # when to look at a still-pending proof again, given how many times
+    # we've already looked and what the calendars told us this time
+    now = time.time() if now is None else now
+    if now < root.ctime + FIRST_CHECK_DELAY:
+        return first_check(root, now)
+    if confirmations_needed is not None:
+        # it's in a block already, so the wait is predictable
+        return now + max(BASE_BACKOFF, confirmations_needed * SECONDS_PER_CONFIRMATION)
+    return now + min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempts)
+
+
+def loop_sleep(next_due: Optional[float], now: Optional[float] = None) -> float:
+    # how long the update loop should sleep before its next pass
+    now = time.time() if now is None else now
+    if next_due is None:
+        return MAX_LOOP_SLEEP
+    return min(MAX_LOOP_SLEEP, max(MIN_LOOP_SLEEP, next_due - now))
+
+
+class RootCadence:
+    # decides when the new root loop polls, and when what it found gets
+    # stamped. it learns how often keybase publishes roots from their ctimes
+    # and polls just after the next one is due, so a root is stamped minutes
+    # after it appears. a seqno is only ever stamped once, and stamps are
+    # held to the calendar budget; roots that show up while it's spent wait
+    # and go out together.
+    def __init__(self, stamps_per_hour: float = STAMPS_PER_HOUR, burst: float = STAMP_BURST):
+        rate = stamps_per_hour / 3600
+        self.budget = TokenBucket(rate=rate, burst=burst, min_rate=rate, max_rate=rate)
+        self.seconds_per_root: Optional[float] = None
+        self.latest: Optional[MerkleRoot] = None  # newest root seen
+        self.pending: List[MerkleRoot] = []  # seen, not stamped yet
+
+    def is_new(self, root: MerkleRoot) -> bool:
+        return self.latest is None or root.seqno > self.latest.seqno
+
+    def observe(self, root: MerkleRoot) -> None:
+        # a new root that checked out and needs stamping
+        if not self.is_new(root):
+            return
+        if self.latest is not None and root.ctime > self.latest.ctime:
+            per_root = (root.ctime - self.latest.ctime) / (root.seqno - self.latest.seqno)
+            if self.seconds_per_root is None:
+                self.seconds_per_root = per_root
+            else:
+                self.seconds_per_root += ROOT_RATE_SMOOTHING * (per_root - self.seconds_per_root)
+            metrics.root_interval.set(self.seconds_per_root)
+        self.latest = root
+        self.pending.append(root)
+
+    def skip(self, root: MerkleRoot) -> None:
+        # seen, but it's stamped already (e.g. before a restart)
+        if self.is_new(root):
+            self.latest = root
+
+    def discard(self, seqnos: Set[int]) -> None:
+        # these turned out to be stamped already
+        self.pending = [root for root in self.pending if root.seqno not in seqnos]
+
+    def take_batch(self) -> List[MerkleRoot]:
+        # what to stamp now, if anything. spends from the budget.
+        if not self.pending or not self.budget.try_acquire():
+            return []
+        batch, self.pending = self.pending, []
+        return batch
+
+    def retry(self, batch: List[MerkleRoot]) -> None:
+        # the stamp failed. try them again with the next batch.
+        self.pending = batch + self.pending
+
+    def next_poll(self, now: Optional[float] = None) -> float:
+        # seconds until the loop should look for a new root
+        now = time.time() if now is None else now
+        if self.latest is None or self.seconds_per_root is None:
+            return MIN_ROOT_POLL
+        wait = self.latest.ctime + self.seconds_per_root + ROOT_POLL_SLACK - now
+        if self.pending:
+            # don't sleep through the moment the budget allows a stamp
+            wait = min(wait, self.budget.wait_time())
+        return min(MAX_ROOT_POLL, max(MIN_ROOT_POLL, wait))
@@ -0,0 +1,399 @@
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import threading
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+import warnings
+
+# local, in-process replacements for everything this bot talks to:
+#   FakeKeybaseAPI - serves merkle roots signed with a throwaway pgp key
+#   FakeCalendar   - an opentimestamps calendar you can flip between pending and confirmed
+#   FakeBot        - bot.chat and bot.kvstore, in memory
+# they're for the benchmark and for poking at things locally, never for production.
+
+
+class _Server:
+    # a ThreadingHTTPServer on a random localhost port, in a daemon thread
+    def __init__(self, handler_cls):
+        handler_cls.owner = self
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), handler_cls)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, content_type='application/octet-stream', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+################################
+
+# keybase merkle root api
+
+class FakeKeybaseAPI(_Server):
+    # serves /_/api/1.0/merkle/root.json, with or without ?seqno=N, in the
+    # same shape keybase does. the chain starts at `first` (nothing before it
+    # gets a prev or skip pointer) and `latest` is served when no seqno is
+    # asked for. roots are signed in order the first time they're needed.
+    #
+    # each root is the top of a small tree of `users` made-up uids, and
+    # /_/api/1.0/merkle/path.json?uid=U&seqno=N serves the path down to U's
+    # leaf. each new root bumps one user's sigchain, so like keybase's tree,
+    # most of it is the same from one root to the next.
+    def __init__(self, first: int = 1, latest: int = 1000, key_bits: int = 2048, users: int = 64):
+        super().__init__(_KeybaseHandler)
+        self.first = first
+        self.latest = latest
+        self.key = _new_signing_key(key_bits)
+        self.uids = [hashlib.sha256(f"user {i}".encode()).hexdigest()[:30] + '19' for i in range(users)]
+        self._roots: Dict[int, dict] = {}
+        self._nodes: Dict[str, str] = {}  # sha512 hex -> node json, shared by every root
+        self._lock = threading.Lock()
+
+    @property
+    def root_url(self) -> str:
+        return f"{self.url}/_/api/1.0/merkle/root.json"
+
+    @property
+    def public_key(self) -> str:
+        return str(self.key.pubkey)
+
+    def install(self):
+        # point the bot's fetching and verification at this server
+        import merkle_root
+        import root_chain
+        merkle_root.KEYBASE_MERKLE_ROOT_URL = self.root_url
+        merkle_root.TEMPLATE_MERKLE_URL = self.root_url + "?seqno={seqno}"
+        root_chain.TEMPLATE_MERKLE_URL = merkle_root.TEMPLATE_MERKLE_URL
+        merkle_root._latest_etag, merkle_root._latest_root = None, None
+        merkle_root.load_verifier(self.public_key)
+        import inclusion
+        inclusion.TEMPLATE_PATH_URL = f"{self.url}/_/api/1.0/merkle/path.json?uid={{uid}}&seqno={{seqno}}"
+        return self
+
+    def root(self, seqno: int) -> dict:
+        with self._lock:
+            if seqno < self.first:
+                raise KeyError(seqno)
+            # every root hashes the ones before it, so sign them in order
+            for missing in range(max(self._roots, default=self.first - 1) + 1, seqno + 1):
+                self._roots[missing] = self._make_root(missing)
+            return self._roots[seqno]
+
+    def _make_root(self, seqno: int) -> dict:
+        from merkle_root import KEYBASE_KID
+        import pgpy
+        body = {
+            'seqno': seqno,
+            'root': self._tree(seqno),
+            'prev': self._hash_of(seqno - 1, hashlib.sha512),
+            'skips': {
+                str(seqno - 2 ** k): self._hash_of(seqno - 2 ** k, hashlib.sha256)
+                for k in range(1, 32) if seqno - 2 ** k >= self.first
+            },
+        }
+        payload_json = json.dumps({'body': body, 'ctime': int(time.time()), 'tag': 'signature'})
+        message = pgpy.PGPMessage.new(payload_json)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            message |= self.key.sign(message)
+        return {
+            'seqno': seqno,
+            'hash': body['root'],
+            'ctime_string': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+            'payload_json': payload_json,
+            'sigs': {KEYBASE_KID: {'sig': str(message)}},
+        }
+
+    def _hash_of(self, seqno: int, hash_fn) -> Optional[str]:
+        if seqno not in self._roots:
+            return None
+        return hash_fn(self._roots[seqno]['payload_json'].encode()).hexdigest()
+
+    def path(self, uid: str, seqno: int) -> List[dict]:
+        # top down, ending at the leaf that would hold uid, whether or not it does
+        node_hash = self.root(seqno)['hash']
+        steps = []
+        prefix = ''
+        while True:
+            val = self._nodes[node_hash]
+            node = json.loads(val)
+            steps.append({'prefix': prefix, 'node': {'hash': node_hash, 'val': val, 'type': node['type']}})
+            children = [child for child in node['tab'] if uid.startswith(child)] if node['type'] == 1 else []
+            if not children:
+                return steps
+            prefix = children[0]
+            node_hash = node['tab'][prefix]
+
+    def _tree(self, seqno: int) -> str:
+        # root n bumps the sigchain of user n % len(uids)
+        leaves = {}
+        for i, uid in enumerate(self.uids):
+            # how many roots from first through seqno bumped this user
+            bumps = (seqno - i) // len(self.uids) - (self.first - 1 - i) // len(self.uids)
+            link_hash = hashlib.sha256(f"{uid} {bumps}".encode()).hexdigest()
+            leaves[uid] = [2, [bumps + 1, link_hash]]
+        return self._add_node('', leaves)
+
+    def _add_node(self, prefix: str, leaves: Dict[str, list]) -> str:
+        # interior nodes split on the next hex digit until there are few enough to be a leaf
+        if len(leaves) <= 4 or len(prefix) == 32:
+            node = {'tab': leaves, 'type': 2}
+        else:
+            groups: Dict[str, Dict[str, list]] = {}
+            for uid, leaf in leaves.items():
+                groups.setdefault(uid[:len(prefix) + 1], {})[uid] = leaf
+            node = {'tab': {child: self._add_node(child, group) for child, group in groups.items()}, 'type': 1}
+        val = json.dumps(node, sort_keys=True, separators=(',', ':'))
+        node_hash = hashlib.sha512(val.encode()).hexdigest()
+        self._nodes[node_hash] = val
+        return node_hash
+
+
+class _KeybaseHandler(_QuietHandler):
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        if parsed.path == '/_/api/1.0/merkle/path.json':
+            return self._path(parse_qs(parsed.query))
+        if parsed.path != '/_/api/1.0/merkle/root.json':
+            return self._send(404, b'{}', 'application/json')
+        seqno = parse_qs(parsed.query).get('seqno')
+        try:
+            root = self.owner.root(int(seqno[0]) if seqno else self.owner.latest)
+        except KeyError:
+            return self._send(404, b'{}', 'application/json')
+        etag = f'"{root["seqno"]}"'
+        if self.headers.get('If-None-Match') == etag:
+            return self._send(304, b'', headers={'ETag': etag})
+        self._send(200, json.dumps(root).encode(), 'application/json', {'ETag': etag})
+
+    def _path(self, query):
+        try:
+            uid, seqno = query['uid'][0], int(query['seqno'][0])
+            root = self.owner.root(seqno)
+            path = self.owner.path(uid, seqno)
+        except (KeyError, ValueError):
+            return self._send(404, b'{}', 'application/json')
+        body = {'status': {'code': 0, 'name': 'OK'}, 'uid': uid, 'root': root, 'path': path}
+        self._send(200, json.dumps(body).encode(), 'application/json')
+
+
+def _new_signing_key(bits: int):
+    import pgpy
+    from pgpy.constants import HashAlgorithm, KeyFlags, PubKeyAlgorithm
+    key = pgpy.PGPKey.new(PubKeyAlgorithm.RSAEncryptOrSign, bits)
+    uid = pgpy.PGPUID.new('stand-in merkle signer')
+    key.add_uid(uid, usage={KeyFlags.Sign}, hashes=[HashAlgorithm.SHA256])
+    return key
+
+
+################################
+
+# opentimestamps calendar
+
+class FakeCalendar(_Server):
+    # POST /digest gives back a pending attestation. GET /timestamp/<hex>
+    # 404s with "Pending confirmation" until `confirmed` is set, and then
+    # returns a bitcoin attestation at `block_height`.
+    def __init__(self, confirmed: bool = False, block_height: int = 600000):
+        super().__init__(_CalendarHandler)
+        self.confirmed = confirmed
+        self.block_height = block_height
+        self.submissions = 0
+        self.lookups = 0
+
+    def install(self, count: int = 1):
+        # use this calendar (and `count - 1` siblings) instead of the real ones
+        import kb_ots
+        calendars = [self] + [FakeCalendar(self.confirmed, self.block_height).start() for _ in range(count - 1)]
+        kb_ots.CALENDAR_URLS = tuple(calendar.url for calendar in calendars)
+        return calendars
+
+    def commitment(self, digest: bytes) -> bytes:
+        return hashlib.sha256(digest + self.url.encode()).digest()
+
+
+class _CalendarHandler(_QuietHandler):
+    def do_POST(self):
+        from opentimestamps.core.notary import PendingAttestation
+        from opentimestamps.core.op import OpAppend, OpSHA256
+        from opentimestamps.core.timestamp import Timestamp
+        digest = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.owner.submissions += 1
+        timestamp = Timestamp(digest)
+        commitment_stamp = timestamp.ops.add(OpAppend(self.owner.url.encode())).ops.add(OpSHA256())
+        commitment_stamp.attestations.add(PendingAttestation(self.owner.url))
+        self._send(200, _serialize_timestamp(timestamp))
+
+    def do_GET(self):
+        from opentimestamps.core.notary import BitcoinBlockHeaderAttestation
+        from opentimestamps.core.op import OpSHA256
+        from opentimestamps.core.timestamp import Timestamp
+        self.owner.lookups += 1
+        commitment = bytes.fromhex(self.path.rsplit('/', 1)[-1])
+        if not self.owner.confirmed:
+            return self._send(404, b'Pending confirmation in Bitcoin blockchain', 'text/plain')
+        timestamp = Timestamp(commitment)
+        timestamp.ops.add(OpSHA256()).attestations.add(BitcoinBlockHeaderAttestation(self.owner.block_height))
+        self._send(200, _serialize_timestamp(timestamp))
+
+
+def _serialize_timestamp(timestamp) -> bytes:
+    from opentimestamps.core.serialize import BytesSerializationContext
+    ctx = BytesSerializationContext()
+    timestamp.serialize(ctx)
+    return ctx.getbytes()
+
+
+################################
+
+# keybase bot
+
+class FakeChat:
+    # enough of bot.chat for this bot: send, edit, read and the raw execute
+    # read used to page through history. like keybase, an edit shows up in
+    # history as a message of its own pointing back at the one it edited.
+    def __init__(self, username: str, latency: float = 0.0):
+        self.username = username
+        self.latency = latency
+        self.messages: Dict[str, Dict[int, str]] = {}  # channel name -> msg_id -> current body
+        self.history: Dict[str, List[dict]] = {}  # channel name -> raw summaries, oldest first
+        self._ids = itertools.count(1)
+
+    async def send(self, channel, message: str):
+        await self._wait()
+        msg_id = next(self._ids)
+        name = _channel_name(channel)
+        self.messages.setdefault(name, {})[msg_id] = message
+        self.history.setdefault(name, []).append(_raw_summary(msg_id, {'type': 'text', 'text': {'body': message}}))
+        return SimpleNamespace(message_id=msg_id)
+
+    async def edit(self, channel, message_id: int, message: str):
+        await self._wait()
+        name = _channel_name(channel)
+        self.messages.setdefault(name, {})[message_id] = message
+        edit = {'type': 'edit', 'edit': {'messageID': message_id, 'body': message}}
+        self.history.setdefault(name, []).append(_raw_summary(next(self._ids), edit))
+        return SimpleNamespace(message_id=message_id)
+
+    async def read(self, channel, pagination=None):
+        await self._wait()
+        messages = sorted(self.messages.get(_channel_name(channel), {}).items(), reverse=True)
+        num = getattr(pagination, 'num', None) or len(messages)
+        return [_summary(msg_id, body) for msg_id, body in messages[:num]]
+
+    async def execute(self, command):
+        await self._wait()
+        options = command['params']['options']
+        pagination = options.get('pagination') or {}
+        num = pagination.get('num') or 100
+        start = int(pagination.get('next') or 0)
+        everything = self.history.get(_channel_name(options['channel']), [])[::-1]
+        page = everything[start:start + num]
+        return {
+            'messages': [{'msg': summary} for summary in page],
+            'pagination': {'num': len(page), 'next': str(start + num), 'last': start + num >= len(everything)},
+        }
+
+    async def _wait(self):
+        import asyncio
+        await asyncio.sleep(self.latency)
+
+
+class FakeKVStore:
+    # bot.kvstore with the same (team, namespace, key) calling convention the
+    # bot uses, including revisions for compare-and-swap puts
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.entries: Dict[tuple, SimpleNamespace] = {}
+
+    async def get(self, team, namespace, entry_key):
+        import asyncio
+        await asyncio.sleep(self.latency)
+        entry = self.entries.get((team, namespace, entry_key))
+        if entry is None:
+            return SimpleNamespace(entry_value=None, revision=0)
+        return SimpleNamespace(entry_value=entry.entry_value, revision=entry.revision)
+
+    async def put(self, team, namespace, entry_key, entry_value, revision: Optional[int] = None):
+        import asyncio
+        await asyncio.sleep(self.latency)
+        key = (team, namespace, entry_key)
+        current = self.entries.get(key)
+        current_revision = current.revision if current else 0
+        if revision is not None and revision != current_revision + 1:
+            raise KVRevisionError(f"revision {revision} for {entry_key} but it's at {current_revision}")
+        self.entries[key] = SimpleNamespace(entry_value=entry_value, revision=current_revision + 1)
+        return SimpleNamespace(revision=current_revision + 1)
+
+
+class KVRevisionError(Exception):
+    pass
+
+
+class FakeBot:
+    def __init__(self, username: str = 'standin', chat_latency: float = 0.0, kvstore_latency: float = 0.0, kvstore=None):
+        self.username = username
+        self.chat = FakeChat(username, chat_latency)
+        # pass a shared FakeKVStore to make several bots look like replicas
+        self.kvstore = kvstore or FakeKVStore(kvstore_latency)
+
+    async def ensure_initialized(self):
+        pass
+
+
+def _channel_name(channel) -> str:
+    # "name", or "name#topic" for a team channel
+    if isinstance(channel, dict):
+        name, topic = channel.get('name', ''), channel.get('topic_name')
+    else:
+        name, topic = getattr(channel, 'name', str(channel)), getattr(channel, 'topic_name', None)
+    return f"{name}#{topic}" if topic else name
+
+
+def _raw_summary(msg_id: int, content: dict) -> dict:
+    return {
+        'id': msg_id,
+        'conv_id': 'standin',
+        'channel': {'name': 'standin', 'public': True},
+        'sender': {'uid': 'standin', 'username': 'standin', 'device_id': 'standin', 'device_name': 'standin'},
+        'sent_at': 0,
+        'sent_at_ms': 0,
+        'unread': False,
+        'content': content,
+    }
+
+
+def _summary(msg_id: int, body: str):
+    return SimpleNamespace(
+        id=msg_id,
+        content=SimpleNamespace(type_name='text', text=SimpleNamespace(body=body), edit=None),
+    )
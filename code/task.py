@@ -1,23 +1,68 @@
 import asyncio
 from base64 import b64decode, b64encode
-from dataclasses import dataclass, field, replace
+from dataclasses import dataclass, field, fields, replace
 from dataclasses_json import dataclass_json
+from datetime import datetime, timezone
 from enum import Enum
+import inspect
 import json
 import logging
-from typing import List
-
-import pykeybasebot.types.chat1 as chat1
+import os
+import struct
+import time
+from typing import Dict, List, Optional, Tuple
+import zlib
 
+from journal import EDITED, Journal, PUBLISHED, STAMPED, UPGRADED
 import kb_ots
 import last_success
-from merkle_root import fetch_keybase_merkle_root, MerkleRoot
+import keybase_api
+import metrics
+from merkle_root import fetch_keybase_merkle_root, MerkleRoot, TEMPLATE_MERKLE_URL, VerificationError
+from proof_index import PRELIMINARY, ProofIndex
+from rate_limit import TokenBucket
+from root_chain import ChainError, ChainVerifier
+import scheduler
+
+
+# how many historical messages to read per page when rebuilding the proof index
+HISTORY_PAGE_SIZE = 100
+# how many proofs can be upgrading against the calendars at once
+UPGRADE_CONCURRENCY = 8
+# how long a proof another replica owns waits before this one looks at it
+# again, in case the ring has changed by then
+NOT_OWNED_DELAY = 60
+# how many times to try a chat api call that keeps timing out
+CHAT_ATTEMPTS = 8
+# keybase won't take a chat message longer than this
+MAX_MESSAGE_LENGTH = 10000
+# new messages are packed to at most this long, which leaves room for the
+# proofs to grow when they're upgraded and the message gets edited
+PACK_MESSAGE_LENGTH = MAX_MESSAGE_LENGTH // 3
+ROOTS_PER_MESSAGE = 16
+# team channels that get a copy of every proof, on top of the bot's own
+# public channel, e.g. "myteam,otherteam#proofs" (no "#" means #general).
+# each root is still fetched, verified and stamped once, and each upgrade
+# edits every copy.
+PUBLISH_CHANNELS = [name.strip() for name in os.environ.get('PUBLISH_CHANNELS', '').split(',') if name.strip()]
+# how many copies are sent or edited at once
+FANOUT_CONCURRENCY = 8
+
+# shared by everything that stamps so concurrent roots go out in one batch
+stamper = kb_ots.BatchStamper()
+# shared by everything that talks to the chat api
+chat_limiter = TokenBucket()
+# msg_id -> the newest status we've recorded for that message. a VERIFIABLE
+# message never changes again, so when history turns up an older copy of it
+# (the original text under its final edit), it can be skipped unparsed.
+status_memo: Dict[int, 'StampStatus'] = {}
+# set with use_journal. without one, nothing in flight survives a restart.
+journal: Optional[Journal] = None
 
 
-# how many historical messages to read at a time
-# if there is a preliminary post further back than this, we
-# will never see it to verify it.
-MESSAGES_TO_CHECK = 30
+def use_journal(j: Optional[Journal]) -> None:
+    global journal
+    journal = j
 
 
 class StampStatus(Enum):
@@ -35,105 +80,689 @@ class StampedMerkleRoot:
     status: StampStatus = StampStatus.PRELIMINARY
 
 
-async def broadcast_new_root(logger, bot):
-    merkle_root = fetch_keybase_merkle_root()
-    logger.debug(f"fetched and validated {merkle_root.seqno}")
+@dataclass
+class StampedMerkleRoots:
+    # version 1 of the chat msg: several roots, each with its own proof.
+    #
+    #   {"version": 1, "status": "PRELIMINARY",
+    #    "roots": [[seqno, ctime_ms, root_hash_b64, b64stamped, is_final], ...],
+    #    "ots": "<base64 of zlib of every root's `.ots`, each prefixed with its length>"}
+    #
+    # `status` is VERIFIABLE once every root is. stable_url is left out since
+    # it's just the seqno, and the proofs are compressed together because
+    # roots stamped in the same batch share most of their path to the chain.
+    roots: List[StampedMerkleRoot]
+    version: int = 1
+
+    @property
+    def status(self) -> StampStatus:
+        if all(root.status == StampStatus.VERIFIABLE for root in self.roots):
+            return StampStatus.VERIFIABLE
+        return StampStatus.PRELIMINARY
+
+    def to_json(self) -> str:
+        roots = sorted(self.roots, key=lambda stamped_root: stamped_root.root.seqno)
+        otss = b''.join(
+            struct.pack('>I', len(ots)) + ots
+            for ots in (b64decode(stamped_root.ots) for stamped_root in roots)
+        )
+        return json.dumps({
+            'version': self.version,
+            'status': self.status.value,
+            'roots': [
+                [
+                    stamped_root.root.seqno,
+                    int(round(stamped_root.root.ctime * 1000)),
+                    b64encode(bytes.fromhex(stamped_root.root.root_hash)).decode('UTF-8'),
+                    stamped_root.root.b64stamped,
+                    int(stamped_root.status == StampStatus.VERIFIABLE),
+                ]
+                for stamped_root in roots
+            ],
+            'ots': b64encode(zlib.compress(otss, 9)).decode('UTF-8'),
+        }, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, raw: str) -> 'StampedMerkleRoots':
+        return cls.from_dict(json.loads(raw))
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'StampedMerkleRoots':
+        otss = zlib.decompress(b64decode(d['ots']))
+        roots = []
+        offset = 0
+        for seqno, ctime_ms, root_hash, b64stamped, is_final in d['roots']:
+            (length,) = struct.unpack_from('>I', otss, offset)
+            ots = otss[offset + 4:offset + 4 + length]
+            offset += 4 + length
+            root = MerkleRoot(
+                seqno=seqno,
+                ctime_string=_ctime_string(ctime_ms),
+                root_hash=b64decode(root_hash).hex(),
+                b64stamped=b64stamped,
+                stable_url=TEMPLATE_MERKLE_URL.format(seqno=seqno),
+            )
+            roots.append(StampedMerkleRoot(
+                root=root,
+                ots=b64encode(ots).decode('UTF-8'),
+                version=d['version'],
+                status=StampStatus.VERIFIABLE if is_final else StampStatus.PRELIMINARY,
+            ))
+        if offset != len(otss):
+            raise ValueError(f"{len(otss) - offset} bytes of proofs left over after {len(roots)} roots")
+        return cls(roots=roots, version=d['version'])
+
+
+MERKLE_ROOT_FIELDS = tuple(f.name for f in fields(MerkleRoot))
+
+
+def decode_stamped_roots(body: dict) -> List[StampedMerkleRoot]:
+    # a hand-rolled from_dict for both versions. dataclass_json works out
+    # the nested dataclass and the enum by reflection on every call, which
+    # adds up over a whole channel's history.
+    version = body.get('version', 0)
+    if version == 1:
+        return StampedMerkleRoots.from_dict(body).roots
+    if version != 0:
+        raise ValueError(f"unknown version {version}")
+    root = body['root']
+    return [StampedMerkleRoot(
+        root=MerkleRoot(**{name: root[name] for name in MERKLE_ROOT_FIELDS if name in root}),
+        ots=body['ots'],
+        version=0,
+        status=StampStatus(body['status']),
+    )]
+
+
+def remember_status(msg_id, status: StampStatus) -> None:
+    status_memo[msg_id] = status
+
+
+def _ctime_string(ctime_ms: int) -> str:
+    # keybase's format, e.g. 2020-03-10T22:10:41.123Z
+    ctime = datetime.fromtimestamp(ctime_ms // 1000, tz=timezone.utc)
+    return f"{ctime.strftime('%Y-%m-%dT%H:%M:%S')}.{ctime_ms % 1000:03d}Z"
+
+
+def index_stamped_root(index: ProofIndex, msg_id, stamped_root: StampedMerkleRoot, next_check: Optional[float] = None):
+    # next_check is only used if the proof isn't indexed yet
+    if next_check is None:
+        next_check = scheduler.first_check(stamped_root.root)
+    index.record(
+        msg_id=msg_id,
+        root=stamped_root.root,
+        ots=b64decode(stamped_root.ots),
+        status=stamped_root.status.value,
+        next_check=next_check,
+        version=stamped_root.version,
+    )
+
+
+async def broadcast_new_root(logger, bot_ready, index: ProofIndex, chain: ChainVerifier = None, cadence: scheduler.RootCadence = None,
+                             index_ready: asyncio.Event = None):
+    # `bot_ready` is the bot, or anything that can be awaited for it. it's
+    # only waited on once there's a stamped root to publish, so on a cold
+    # start the first root is fetched and stamped while the bot is set up.
+    # without a cadence, whatever the current root is gets stamped. with one,
+    # only seqnos it hasn't seen, once its calendar budget allows.
+    # `index_ready` is set once the index has read back what's already in
+    # the channel. until then roots are fetched and checked, not stamped.
+    if cadence is None:
+        stamped = await stamp_new_root(logger, chain)
+        stamped = [stamped] if stamped is not None else []
+    else:
+        await poll_new_root(logger, index, chain, cadence)
+        if index_ready is not None and not index_ready.is_set():
+            logger.debug("the proof index is still being rebuilt - not stamping yet")
+            return
+        # some of what was seen before the rebuild may turn out to be published
+        cadence.discard({root.seqno for root in cadence.pending if index.published_seqnos(root.seqno, root.seqno)})
+        batch = cadence.take_batch()
+        stamped = await stamp_roots(logger, batch) if batch else []
+        if batch and not stamped:
+            cadence.retry(batch)
+    if not stamped:
+        return
+    bot = await bot_ready if inspect.isawaitable(bot_ready) else bot_ready
+    await publish_stamped_roots(logger, bot, index, stamped)
+
+
+async def stamp_new_root(logger, chain: ChainVerifier = None) -> Optional[Tuple[MerkleRoot, str]]:
+    # the current root and its base64 ots, or None if any step failed
+    merkle_root = await fetch_new_root(logger, chain)
+    if merkle_root is None:
+        return None
+    stamped = await stamp_roots(logger, [merkle_root])
+    return stamped[0] if stamped else None
+
+
+async def poll_new_root(logger, index: ProofIndex, chain: ChainVerifier, cadence: scheduler.RootCadence) -> None:
+    # between stamps, a root is fetched (a 304 if it hasn't changed) and, if
+    # it's new, checked against the chain right away, so it's ready to stamp
+    # the moment the budget allows
     try:
-        ots = await kb_ots.stamp(merkle_root.data_to_stamp)
-    except kb_ots.StampError as e:
-        logger.error(f"error stamping {merkle_root.seqno}: {e}")
+        merkle_root = await fetch_keybase_merkle_root()
+    except (keybase_api.FetchError, VerificationError) as e:
+        logger.error(f"error fetching the current merkle root: {e}")
+        return
+    if not cadence.is_new(merkle_root):
+        logger.debug(f"still at {merkle_root.seqno} - nothing to stamp")
+        return
+    if index.published_seqnos(merkle_root.seqno, merkle_root.seqno):
+        # stamped before a restart, or by another replica
+        logger.debug(f"{merkle_root.seqno} is already published")
+        cadence.skip(merkle_root)
+        return
+    if not await _links_back(logger, chain, merkle_root):
         return
+    cadence.observe(merkle_root)
+    logger.debug(f"fetched and validated {merkle_root.seqno}, {len(cadence.pending)} waiting to be stamped")
 
-    stamped_root = StampedMerkleRoot(
-        version=0,
-        root=merkle_root,
-        ots=ots,
-        status=StampStatus.PRELIMINARY,
+
+async def fetch_new_root(logger, chain: ChainVerifier = None) -> Optional[MerkleRoot]:
+    try:
+        merkle_root = await fetch_keybase_merkle_root()
+    except (keybase_api.FetchError, VerificationError) as e:
+        logger.error(f"error fetching the current merkle root: {e}")
+        return None
+    logger.debug(f"fetched and validated {merkle_root.seqno}")
+    if not await _links_back(logger, chain, merkle_root):
+        return None
+    return merkle_root
+
+
+async def _links_back(logger, chain: Optional[ChainVerifier], merkle_root: MerkleRoot) -> bool:
+    if chain is None:
+        return True
+    try:
+        await chain.verify(merkle_root)
+    except (keybase_api.FetchError, VerificationError, ChainError) as e:
+        logger.error(f"{merkle_root.seqno} doesn't link back to the last root we verified: {e}")
+        return False
+    return True
+
+
+async def stamp_roots(logger, merkle_roots: List[MerkleRoot]) -> List[Tuple[MerkleRoot, str]]:
+    # (root, base64 ots) pairs, all from one calendar submission, or [] if it failed
+    otss = await asyncio.gather(
+        *(stamper.stamp(merkle_root.data_to_stamp) for merkle_root in merkle_roots),
+        return_exceptions=True,
     )
+    for ots in otss:
+        if isinstance(ots, kb_ots.StampError):
+            logger.error(f"error stamping {', '.join(str(merkle_root.seqno) for merkle_root in merkle_roots)}: {ots}")
+            return []
+        if isinstance(ots, BaseException):
+            raise ots
+    stamped = list(zip(merkle_roots, otss))
+    if journal is not None:
+        # if we die before they're published, publish these stamps instead of making more
+        for merkle_root, ots in stamped:
+            journal.append(STAMPED, seqno=merkle_root.seqno, root=merkle_root.to_dict(), ots=ots)
+        await journal.commit()
+    return stamped
+
+
+async def publish_stamped_root(logger, bot, index: ProofIndex, merkle_root: MerkleRoot, ots: str):
+    await publish_stamped_roots(logger, bot, index, [(merkle_root, ots)])
 
-    my_public_channel = chat1.ChatChannel(name=bot.username, public=True)
+
+async def publish_stamped_roots(logger, bot, index: ProofIndex, stamped: List[Tuple[MerkleRoot, str]]):
+    # as few messages as they'll fit in. `stamped` is (root, base64 ots) pairs.
+    stamped_roots = [
+        StampedMerkleRoot(version=1, root=merkle_root, ots=ots, status=StampStatus.PRELIMINARY)
+        for merkle_root, ots in sorted(stamped, key=lambda pair: pair[0].seqno)
+    ]
+    my_public_channel = _public_channel(bot)
+    copies = []
+    for message in _pack(stamped_roots):
+        body = message.to_json()
+        try:
+            with metrics.timed('chat_send'):
+                res = await retry_if_timeout(logger, bot.chat.send, my_public_channel, body)
+        except Exception as e:
+            logger.error(f"error broadcasting preliminary stamp: {e}")
+            raise
+        seqnos = [stamped_root.root.seqno for stamped_root in message.roots]
+        logger.info(f"broadcasted {seqnos} at msg_id {res.message_id}")
+        for stamped_root in message.roots:
+            index_stamped_root(index, res.message_id, stamped_root, next_check=scheduler.first_check(stamped_root.root))
+        remember_status(res.message_id, message.status)
+        if journal is not None:
+            journal.append(PUBLISHED, msg_id=res.message_id, seqnos=seqnos)
+        metrics.record_first_proof()
+        # the message in the bot's own channel is the one that's tracked.
+        # copies are recorded against its msg_id.
+        copies.extend(
+            _send_copy(logger, bot, index, res.message_id, destination, body)
+            for destination in PUBLISH_CHANNELS
+        )
+    await _fan_out(copies)
+
+
+async def _send_copy(logger, bot, index: ProofIndex, msg_id, destination: str, body: str):
     try:
-        res = await retry_if_timeout(logger, bot.chat.send, my_public_channel, stamped_root.to_json())
+        with metrics.timed('chat_send'):
+            res = await retry_if_timeout(logger, bot.chat.send, _team_channel(destination), body)
     except Exception as e:
-        logger.error(f"error broadcasting preliminary stamp: {e}")
-        raise
-    logger.info(f"broadcasted {merkle_root.seqno} at msg_id {res.message_id}")
+        logger.error(f"error sending a copy of message {msg_id} to {destination}: {e}")
+        return
+    index.record_copy(msg_id, destination, res.message_id)
+
+
+async def _edit_copies(logger, bot, index: ProofIndex, msg_id, body: str):
+    # bring every copy of a message in line with the one in the bot's channel
+    async def edit_copy(destination, copy_msg_id):
+        try:
+            with metrics.timed('chat_edit'):
+                await retry_if_timeout(logger, bot.chat.edit, _team_channel(destination), copy_msg_id, body)
+        except Exception as e:
+            logger.error(f"error editing the copy of message {msg_id} in {destination}: {e}")
+    await _fan_out([edit_copy(destination, copy_msg_id) for destination, copy_msg_id in index.copies(msg_id).items()])
+
+
+async def _fan_out(coros) -> None:
+    # at most FANOUT_CONCURRENCY at a time. they're also paced by
+    # chat_limiter like any other chat call.
+    slots = asyncio.Semaphore(FANOUT_CONCURRENCY)
+
+    async def run(coro):
+        async with slots:
+            await coro
+    await asyncio.gather(*[run(coro) for coro in coros])
+
+
+def _public_channel(bot):
+    # pykeybasebot's types take most of a second to import, so they wait
+    # until there's something to send
+    import pykeybasebot.types.chat1 as chat1
+    return chat1.ChatChannel(name=bot.username, public=True)
+
+
+def _team_channel(destination: str):
+    # "team" or "team#channel"
+    import pykeybasebot.types.chat1 as chat1
+    team, _, topic = destination.partition('#')
+    return chat1.ChatChannel(name=team, members_type='team', topic_name=topic or 'general')
+
+
+def _pack(stamped_roots: List[StampedMerkleRoot], max_length: int = PACK_MESSAGE_LENGTH) -> List[StampedMerkleRoots]:
+    # greedily fill each message up to max_length
+    messages = []
+    current: List[StampedMerkleRoot] = []
+    for stamped_root in stamped_roots:
+        candidate = current + [stamped_root]
+        if current and (len(candidate) > ROOTS_PER_MESSAGE or len(StampedMerkleRoots(candidate).to_json()) > max_length):
+            messages.append(StampedMerkleRoots(current))
+            candidate = [stamped_root]
+        current = candidate
+    if current:
+        messages.append(StampedMerkleRoots(current))
+    return messages
 
 
 async def retry_if_timeout(logger, func, *args, **kwargs):
-    for i in range(0, 100):
+    # every attempt waits its turn in chat_limiter, and every timeout slows
+    # the limiter down, so retries back off on their own
+    for i in range(0, CHAT_ATTEMPTS):
+        await chat_limiter.acquire()
         try:
             result = await func(*args, **kwargs)
         except asyncio.TimeoutError:
             logger.error(f"got a timeout error on attempt {i+1}. retrying...")
-            await asyncio.sleep(0.5)
+            chat_limiter.on_timeout()
+            metrics.chat_retries.inc()
             continue
+        chat_limiter.on_success()
         break
     else:
         raise asyncio.TimeoutError("retries exhausted :(")
     return result
 
 
-async def update_messages(logger, bot):
-    channel = chat1.ChatChannel(name=bot.username, public=True)
-    pagination = chat1.Pagination(num=MESSAGES_TO_CHECK)
-    all_posts = await retry_if_timeout(logger, bot.chat.read, channel=channel, pagination=pagination)
-    for m in reversed(all_posts):
-        msg_id = m.id
-        body = ""
+async def update_messages(logger, bot, index: ProofIndex, owns=None):
+    # `owns(msg_id)` says which messages are this replica's to upgrade.
+    # None means all of them.
+    if index.needs_rebuild:
+        await rebuild_index(logger, bot, index)
+
+    # upgrades run UPGRADE_CONCURRENCY at a time. the edits that follow
+    # them are paced separately by chat_limiter inside retry_if_timeout.
+    upgrade_slots = asyncio.Semaphore(UPGRADE_CONCURRENCY)
+    by_message: Dict[int, List] = {}
+    not_owned = []
+    for proof in index.pending():
+        if owns is None or owns(proof.msg_id):
+            by_message.setdefault(proof.msg_id, []).append(proof)
+        else:
+            not_owned.append(proof)
+    if not_owned:
+        # another replica's. left due, they'd wake the loop every few seconds.
+        index.postpone(not_owned, time.time() + NOT_OWNED_DELAY)
+    results = await asyncio.gather(
+        *[
+            update_message(logger, bot, msg_id, proofs, index, upgrade_slots)
+            for msg_id, proofs in by_message.items()
+        ],
+        return_exceptions=True,
+    )
+    for msg_id, result in zip(by_message, results):
+        if isinstance(result, Exception):
+            logger.error(f"message {msg_id} failed to update: {result!r}")
+    oldest = index.oldest_pending()
+    metrics.record_backlog(index.count(PRELIMINARY), oldest.root.ctime if oldest else None)
+    # everything this pass verified, in one kvstore write
+    await last_success.flush(bot)
+    if journal is not None:
+        await journal.checkpoint()
+
+
+async def resume(logger, bot, index: ProofIndex):
+    # finish what the journal says the last run was in the middle of
+    if journal is None or not (journal.open_stamps or journal.open_upgrades):
+        return
+    if journal.open_stamps:
+        # some may have gone out right before the crash, so look first
+        await catch_up(logger, bot, index)
+        unpublished = []
+        for seqno, record in sorted(journal.open_stamps.items()):
+            if index.published_seqnos(seqno, seqno):
+                journal.append(PUBLISHED, msg_id=None, seqnos=[seqno])
+            else:
+                unpublished.append((MerkleRoot.from_dict(record['root']), record['ots']))
+        if unpublished:
+            logger.info(f"publishing {len(unpublished)} roots stamped before the restart")
+            await publish_stamped_roots(logger, bot, index, unpublished)
+
+    upgraded: Dict[int, Dict[int, str]] = {}
+    for (msg_id, seqno), record in journal.open_upgrades.items():
+        upgraded.setdefault(msg_id, {})[seqno] = record['ots']
+    for msg_id, otss in upgraded.items():
+        proofs = {proof.root.seqno: proof for proof in index.message(msg_id)}
+        finished = {
+            seqno: replace(_from_index(proofs[seqno]), status=StampStatus.VERIFIABLE, ots=ots)
+            for seqno, ots in otss.items() if seqno in proofs
+        }
+        if not finished:
+            journal.append(EDITED, msg_id=msg_id, seqnos=list(otss))
+            continue
+        logger.info(f"message {msg_id} has {len(finished)} roots upgraded before the restart")
         try:
-            content_type = m.content.type_name
-            if content_type not in ('edit', 'text'):
-                # e.g. a `deletehistory`
-                logger.debug(f"message {msg_id} is a {content_type} - skip")
-                continue
-            stamped_root = StampedMerkleRoot.from_json((m.content.text or m.content.edit).body)
+            await edit_in_upgrades(logger, bot, msg_id, finished, index)
         except Exception as e:
-            # any errors in here we should probably fix
-            logger.error(f"message {msg_id} doesn't parse as a stamped root ({e}) - skip - {m}")
+            logger.error(f"message {msg_id} failed to update: {e!r}")
+    await last_success.flush(bot)
+    await journal.checkpoint()
+
+
+def _from_index(proof) -> StampedMerkleRoot:
+    return StampedMerkleRoot(
+        root=proof.root,
+        ots=b64encode(proof.ots).decode('UTF-8'),
+        version=proof.version,
+        status=StampStatus(proof.status),
+    )
+
+
+async def rebuild_index(logger, bot, index: ProofIndex):
+    # page through the whole channel history, newest first, and record every
+    # stamped root we've ever published. after a restore from a snapshot,
+    # stop at the newest message the snapshot already had.
+    catch_up_after = index.catch_up_after
+    found = await _index_history(logger, bot, index, catch_up_after)
+    index.mark_rebuilt()
+    if catch_up_after is not None:
+        logger.info(f"caught the restored proof index up with {found} newer messages")
+    else:
+        logger.info(f"rebuilt the proof index from {found} messages")
+
+
+async def catch_up(logger, bot, index: ProofIndex):
+    # read whatever other replicas (or a backfill) have added to the
+    # channel since we last looked
+    found = await _index_history(logger, bot, index, index.seen_through)
+    if found:
+        logger.info(f"read {found} new messages from the channel")
+
+
+async def _index_history(logger, bot, index: ProofIndex, stop_after: Optional[int]) -> int:
+    # record every stamped root in the channel newer than stop_after, and
+    # remember the newest message read. returns how many messages had roots.
+    newest = stop_after or 0
+    messages: Dict[int, List[StampedMerkleRoot]] = {}
+    async for m in _history(logger, bot, _public_channel(bot), stop_after):
+        newest = max(newest, m.id)
+        parsed = parse_stamped_roots(logger, m)
+        if parsed is None:
             continue
-        if stamped_root.version != 0:
-            logger.debug(f"message {msg_id} has an old version - skip")
+        msg_id, stamped_roots = parsed
+        # history is newest first, so the first body seen for a message is
+        # its latest edit. anything older is superseded.
+        messages.setdefault(msg_id, stamped_roots)
+
+    # a root moved out of a message that outgrew the length limit belongs to
+    # the newer message, even if the old one still has it (i.e. the edit
+    # taking it out never went through)
+    holders: Dict[int, int] = {}
+    for msg_id, stamped_roots in messages.items():
+        for stamped_root in stamped_roots:
+            seqno = stamped_root.root.seqno
+            holders[seqno] = max(msg_id, holders.get(seqno, 0), index.newest_holder(seqno) or 0)
+    for msg_id, stamped_roots in messages.items():
+        kept = [stamped_root for stamped_root in stamped_roots if holders[stamped_root.root.seqno] == msg_id]
+        kept_seqnos = {stamped_root.root.seqno for stamped_root in kept}
+        moved = [proof.root.seqno for proof in index.message(msg_id) if proof.root.seqno not in kept_seqnos]
+        if moved:
+            index.forget(msg_id, moved)
+        for stamped_root in kept:
+            index_stamped_root(index, msg_id, stamped_root)
+        if all(stamped_root.status == StampStatus.VERIFIABLE for stamped_root in kept):
+            remember_status(msg_id, StampStatus.VERIFIABLE)
+    found = len(messages)
+    for destination in PUBLISH_CHANNELS:
+        await rebuild_copies(logger, bot, index, destination)
+    if newest > (index.seen_through or 0):
+        index.set_meta('seen_through', str(newest))
+    return found
+
+
+async def rebuild_copies(logger, bot, index: ProofIndex, destination: str):
+    # match the bot's messages in a team channel back to the messages they
+    # copy, by the first seqno in them. only reads as far back as the newest
+    # copy the index already knows about.
+    found = set()
+    async for m in _history(logger, bot, _team_channel(destination), index.newest_copy(destination)):
+        if m.sender.username != bot.username:
             continue
-        if stamped_root.status is StampStatus.VERIFIABLE:
-            logger.debug(f"message {msg_id} is already verifiable - skip")
-        elif stamped_root.status is StampStatus.PRELIMINARY:
-            await update_ots_for_msg(logger, bot, msg_id, stamped_root)
-            await asyncio.sleep(1)  # necessary for broadcasting to succeed :/
-        else:
-            logger.error(f"message {m.id} does not have a valid status: {stamped_root}")
+        parsed = parse_stamped_roots(logger, m, use_memo=False)
+        if parsed is None:
+            continue
+        copy_msg_id, stamped_roots = parsed
+        original = index.lookup(stamped_roots[0].root.seqno)
+        if original is not None:
+            index.record_copy(original.msg_id, destination, copy_msg_id)
+            found.add(copy_msg_id)
+    logger.info(f"found {len(found)} copies in {destination}")
 
 
-async def update_ots_for_msg(logger, bot, msg_id, stamped_root):
+async def _history(logger, bot, channel, stop_after: Optional[int] = None):
+    # every message in a channel, newest first, stopping before stop_after
+    import pykeybasebot.types.chat1 as chat1
+    # bot.chat.read would do this, but the raw execute below doesn't
+    await bot.ensure_initialized()
+    pagination = chat1.Pagination(num=HISTORY_PAGE_SIZE)
+    while True:
+        read_request = {"method": "read", "params": {"options": {
+            "channel": channel.to_dict(),
+            "pagination": pagination.to_dict(),
+        }}}
+        res = await retry_if_timeout(logger, bot.chat.execute, read_request)
+        thread = chat1.Thread.from_dict(res)
+        for m in (thread.messages or []):
+            if m.msg is None:
+                continue
+            if stop_after is not None and m.msg.id <= stop_after:
+                return
+            yield m.msg
+        if thread.pagination is None or thread.pagination.last or not thread.messages:
+            return
+        pagination = chat1.Pagination(num=HISTORY_PAGE_SIZE, next=thread.pagination.next)
+
+
+def parse_stamped_roots(logger, m, use_memo: bool = True) -> Optional[Tuple[int, List[StampedMerkleRoot]]]:
+    # returns (msg_id, stamped_roots) for a published proof message, or None.
+    # v0 messages have one root and v1 messages have one or more.
+    # status_memo only knows msg_ids in the bot's own channel, so any other
+    # channel's messages are parsed with use_memo=False.
+    if m is None:
+        return None
+    msg_id = m.id
+    try:
+        content_type = m.content.type_name
+        if content_type not in ('edit', 'text'):
+            # e.g. a `deletehistory`
+            logger.debug(f"message {msg_id} is a {content_type} - skip")
+            return None
+        if content_type == 'edit':
+            # an edit's body belongs to the message it edited
+            msg_id = m.content.edit.message_id
+        if use_memo and status_memo.get(msg_id) == StampStatus.VERIFIABLE:
+            # already have the final copy of this one
+            return None
+        body = json.loads((m.content.text or m.content.edit).body)
+        if body.get('version', 0) not in (0, 1):
+            logger.debug(f"message {msg_id} has an unknown version {body.get('version')} - skip")
+            return None
+        stamped_roots = decode_stamped_roots(body)
+    except Exception as e:
+        # any errors in here we should probably fix
+        logger.error(f"message {msg_id} doesn't parse as a stamped root ({e}) - skip - {m}")
+        return None
+    return msg_id, stamped_roots
+
+
+async def update_message(logger, bot, msg_id, proofs, index: ProofIndex, upgrade_slots=None):
+    # `proofs` are the pending IndexedProofs in one message
+    if proofs[0].version == 0:
+        (proof,) = proofs
+        return await update_ots_for_msg(logger, bot, msg_id, _from_index(proof), index, upgrade_slots, proof.attempts)
+
+    results = await asyncio.gather(*[
+        _upgrade(logger, msg_id, _from_index(proof), index, upgrade_slots, proof.attempts)
+        for proof in proofs
+    ])
+    finished = {
+        proof.root.seqno: replace(_from_index(proof), status=StampStatus.VERIFIABLE, ots=result.ots)
+        for proof, result in zip(proofs, results) if result is not None
+    }
+    if not finished:
+        return
+
+    await edit_in_upgrades(logger, bot, msg_id, finished, index)
+
+
+async def edit_in_upgrades(logger, bot, msg_id, finished: Dict[int, StampedMerkleRoot], index: ProofIndex):
+    # `finished` is seqno -> the now VERIFIABLE stamped root, for the roots
+    # in this message that just upgraded. a v1 message is rewritten whole,
+    # with every root in it, in a single edit. a v0 message is its one root.
+    proofs = index.message(msg_id)
+    if journal is not None:
+        # an upgrade that's made it this far is never redone after a restart
+        for seqno, stamped_root in finished.items():
+            journal.append(UPGRADED, msg_id=msg_id, seqno=seqno, ots=stamped_root.ots)
+        await journal.commit()
+    upgraded = list(finished)
+    if proofs and proofs[0].version == 0:
+        (message,) = finished.values()
+    else:
+        message = StampedMerkleRoots([finished.get(proof.root.seqno) or _from_index(proof) for proof in proofs])
+        if len(message.to_json()) > MAX_MESSAGE_LENGTH:
+            # the proofs grew past what keybase will take. keep as many as
+            # fit in this message and move the rest to new ones.
+            message, *rest = _pack(message.roots, MAX_MESSAGE_LENGTH)
+            # the moved roots are packed like new ones, so they have room to grow too
+            overflow = _pack([stamped_root for moved in rest for stamped_root in moved.roots])
+            await _move_roots(logger, bot, index, msg_id, overflow)
+            kept = {stamped_root.root.seqno for stamped_root in message.roots}
+            finished = {seqno: stamped_root for seqno, stamped_root in finished.items() if seqno in kept}
+    body = message.to_json()
+    channel = _public_channel(bot)
+    try:
+        with metrics.timed('chat_edit'):
+            await retry_if_timeout(logger, bot.chat.edit, channel, msg_id, body)
+    except Exception as e:
+        logger.error(f"message {msg_id} error broadcasting verifiable stamps: {e}")
+        raise
+    logger.info(f"message {msg_id} now has {len(finished)} more verifiable roots ({message.status.value})")
+    for stamped_root in finished.values():
+        index_stamped_root(index, msg_id, stamped_root)
+    remember_status(msg_id, message.status)
+    await _edit_copies(logger, bot, index, msg_id, body)
+    if journal is not None:
+        journal.append(EDITED, msg_id=msg_id, seqnos=upgraded)
+    last_success.record(max(upgraded))
+
+
+async def _move_roots(logger, bot, index: ProofIndex, msg_id, messages: List[StampedMerkleRoots]):
+    # post `messages` as new messages, then stop tracking their roots under
+    # msg_id. the caller's edit takes them out of msg_id itself. if it never
+    # gets that far, they're in the channel twice rather than not at all.
+    channel = _public_channel(bot)
+    copies = []
+    for message in messages:
+        body = message.to_json()
+        with metrics.timed('chat_send'):
+            res = await retry_if_timeout(logger, bot.chat.send, channel, body)
+        seqnos = [stamped_root.root.seqno for stamped_root in message.roots]
+        logger.info(f"message {msg_id} outgrew the length limit - moved {seqnos} to msg_id {res.message_id}")
+        for stamped_root in message.roots:
+            index_stamped_root(index, res.message_id, stamped_root)
+        remember_status(res.message_id, message.status)
+        index.forget(msg_id, seqnos)
+        copies.extend(
+            _send_copy(logger, bot, index, res.message_id, destination, body)
+            for destination in PUBLISH_CHANNELS
+        )
+    await _fan_out(copies)
+
+
+async def _upgrade(logger, msg_id, stamped_root, index: ProofIndex, upgrade_slots=None, attempts=0) -> Optional[kb_ots.UpgradeResult]:
+    # the upgrade result if the proof is final now. otherwise reschedules
+    # the next check and returns None.
     seqno = stamped_root.root.seqno
     ots_data = b64decode(stamped_root.ots)
 
     try:
-        completed_ots, is_final = await kb_ots.upgrade(
-            identifier=msg_id,
-            raw_data=stamped_root.root.data_to_stamp,
-            ots_data=ots_data,
-        )
+        async with (upgrade_slots or asyncio.Semaphore(1)):
+            result = await kb_ots.upgrade(
+                # the root, not the message. the other roots in a v1 message
+                # may still need the calendar lookups this one shares, and
+                # a root keeps its seqno when it's moved to another message.
+                identifier=seqno,
+                raw_data=stamped_root.root.data_to_stamp,
+                ots_data=ots_data,
+            )
     except (kb_ots.VerifyError, kb_ots.UpgradeError) as e:
-        logger.info(f"message {msg_id} failed to verify: {e}")
-        return
+        logger.info(f"message {msg_id} ({seqno}) failed to verify: {e}")
+        index.reschedule(msg_id, seqno, scheduler.next_check(stamped_root.root, attempts))
+        return None
 
-    if not is_final:
-        logger.info(f"message {msg_id} is not yet on chain")
+    if not result.is_final:
+        next_check = scheduler.next_check(stamped_root.root, attempts, result.confirmations_needed)
+        logger.info(f"message {msg_id} ({seqno}) is not yet on chain - next check in {int(next_check - time.time())}s")
+        index.reschedule(msg_id, seqno, next_check)
+        return None
+    return result
+
+
+async def update_ots_for_msg(logger, bot, msg_id, stamped_root, index: ProofIndex, upgrade_slots=None, attempts=0):
+    # a v0 message, with just the one root
+    result = await _upgrade(logger, msg_id, stamped_root, index, upgrade_slots, attempts)
+    if result is None:
         return
 
     verifiable_stamp = replace(stamped_root,
         status=StampStatus.VERIFIABLE,
-        ots=completed_ots,
+        ots=result.ots,
     )
-    channel = chat1.ChatChannel(name=bot.username, public=True)
-
-    # edit the message with the new deets
-    seqno = verifiable_stamp.root.seqno
-    try:
-        res = await retry_if_timeout(logger, bot.chat.edit, channel, msg_id, verifiable_stamp.to_json())
-    except Exception as e:
-        logger.error(f"message {msg_id} error broadcasting verifiable stamp: {e}")
-        raise
-    logger.info(f"message {msg_id} is now verifiable")
-    await last_success.update(bot, seqno)
+    await edit_in_upgrades(logger, bot, msg_id, {verifiable_stamp.root.seqno: verifiable_stamp}, index)
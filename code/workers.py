@@ -0,0 +1,74 @@
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor
+import functools
+import logging
+import os
+from typing import Optional, Tuple
+
+
+# where the CPU-heavy parts of verification run (pgp signatures, walking ots
+# proofs), so they don't hold up the event loop and everything else on it:
+# chat replies, edits and both proof loops. a process pool by default.
+# WORKER_PROCESSES=0 runs everything inline instead, and use_executor()
+# takes any concurrent.futures.Executor.
+WORKER_PROCESSES = int(os.environ.get('WORKER_PROCESSES', min(4, os.cpu_count() or 1)))
+logger = logging.getLogger(__name__)
+
+_executor: Optional[Executor] = None
+_custom = False
+# the verifier key and header store path the default pool was started with
+_pool_state: Optional[Tuple] = None
+
+
+def use_executor(executor: Optional[Executor]) -> None:
+    # None goes back to the default
+    global _executor, _custom
+    if _executor is not None and not _custom:
+        _executor.shutdown(wait=False)
+    _executor, _custom = executor, executor is not None
+
+
+def start() -> None:
+    # start the workers now rather than on the first verify, which would
+    # otherwise wait on them starting up (and the loop along with it)
+    executor = _get_executor()
+    if executor is not None:
+        executor.submit(int).result()
+
+
+async def run(func, *args, **kwargs):
+    # `func` and its arguments have to be picklable for the process pool,
+    # so stick to module-level functions and plain data
+    executor = _get_executor()
+    if executor is None:
+        return func(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+def _get_executor() -> Optional[Executor]:
+    global _executor, _pool_state
+    if _custom or WORKER_PROCESSES <= 0:
+        return _executor
+    import kb_ots
+    import merkle_root
+    store = kb_ots.header_store
+    state = (merkle_root.verifier_key, store.path if store is not None else None)
+    if _executor is not None and state != _pool_state:
+        # the key or header store changed since the workers started
+        _executor.shutdown(wait=False)
+        _executor = None
+    if _executor is None:
+        _executor = ProcessPoolExecutor(WORKER_PROCESSES, initializer=_init_worker, initargs=state)
+        _pool_state = state
+        logger.debug(f"started {WORKER_PROCESSES} verification workers")
+    return _executor
+
+
+def _init_worker(armored_key: Optional[str], headers_path: Optional[str]) -> None:
+    # give each worker the same key and header store as the bot
+    import block_headers
+    import kb_ots
+    import merkle_root
+    merkle_root.load_verifier(armored_key)
+    kb_ots.use_block_headers(block_headers.BlockHeaderStore(headers_path) if headers_path else None)